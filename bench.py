@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+    Benchmarks of the fgr2.py hot paths
+
+Each case runs in a fresh process, in a scratch directory holding the map
+and a routing map generated once up front, and records its wall time (best
+of --repeat runs), the peak RSS of the process and ops/sec:
+
+    mapfile      do_mapfile(), parsing the map           map entries/sec
+    mapcache     do_mapfile(), from the topology cache   map entries/sec
+    fgrfile      do_fgrfile(), the routing map and costs clients/sec
+    rtgens       main_rtgens()                           nodes/sec
+    rtgenp       main_rtgenp()                           nodes/sec
+    hybrid       select_client_hybrid()                  ranks/sec
+    gen_shell    gen_shell()                             ranks/sec
+    debugclient  main_debugclient()                      clients/sec
+
+Results go to a JSON file. Against a baseline (a results file of an earlier
+run), a case that got --threshold slower, or grew its peak RSS as much, is
+flagged as a regression and the exit status is 1:
+
+    ./bench.py --output bench.json
+    ./bench.py --baseline bench.json --output new.json
+
+Scale 1 is the shipped titan.map, larger scales are synthetic topologies
+of topogen.py --scale. The placement cases place --numranks ranks per
+scale, 2016 on Titan, 16128 at scale 8.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FGR = os.path.join(HERE, "fgr2.py")
+MAP = "topology.map"
+
+CASES = ["mapfile", "mapcache", "fgrfile", "rtgens", "rtgenp", "hybrid", "gen_shell", "debugclient"]
+
+
+#
+# The cases, run in the child. Each does its untimed setup and returns the
+# timed body, which returns its number of ops.
+#
+
+def bench_mapfile(fgr, args):
+    def run():
+        fgr.do_mapfile()
+        return len(fgr.G.CNAME2NID)
+    return ["mapinfo", "--map", MAP, "--nocache"], None, run
+
+def bench_mapcache(fgr, args):
+    def run():
+        fgr.do_mapfile()
+        return len(fgr.G.CNAME2NID)
+    return ["mapinfo", "--map", MAP], None, run
+
+def bench_fgrfile(fgr, args):
+    def run():
+        fgr.do_fgrfile()
+        return len(fgr.G.CLIENTS)
+    return ["debugclient", "--map", MAP], fgr.fgr_prepare, run
+
+def bench_rtgens(fgr, args):
+    def run():
+        fgr.main_rtgens()
+        return len(fgr.G.CNAME2NID)
+    return ["rtgens", "--map", MAP, "--fgrfile", "routing-s.map"], None, run
+
+def bench_rtgenp(fgr, args):
+    def run():
+        fgr.main_rtgenp()
+        return len(fgr.G.CNAME2NID)
+    return ["rtgenp", "--map", MAP, "--fgrfile", "routing-p.map", "--procs", str(args.procs)], None, run
+
+def prepare_placement(fgr):
+    fgr.fgr_prepare()
+    fgr.G.COSTS, fgr.G.RTR_CLIENTS, fgr.G.LNET2OST, fgr.G.OST2LNET
+    return fgr.partition_routers(fgr.ARGS.partition)
+
+def placement_args(args):
+    return ["placement", "--map", MAP, "--partition", args.partition, "--numranks", str(args.numranks)]
+
+def bench_hybrid(fgr, args):
+    rtrs = []
+    def setup():
+        rtrs.extend(prepare_placement(fgr))
+    def run():
+        fgr.select_client_hybrid(rtrs, args.numranks)
+        return args.numranks
+    return placement_args(args), setup, run
+
+def bench_gen_shell(fgr, args):
+    def setup():
+        fgr.select_client_hybrid(prepare_placement(fgr), args.numranks)
+    def run():
+        fgr.gen_shell(fgr.gen_ofile_name())
+        return args.numranks
+    return placement_args(args), setup, run
+
+def bench_debugclient(fgr, args):
+    def run():
+        fgr.main_debugclient()
+        return len(fgr.G.CLIENTS)
+    return ["debugclient", "--map", MAP], None, run
+
+
+def run_case(args):
+    """
+    child: run one case in the current directory, print its result as JSON
+    """
+    sys.path.insert(0, HERE)
+    import fgr2 as fgr
+
+    fgr_args, setup, run = globals()["bench_" + args.case](fgr, args)
+    sys.argv = [FGR] + fgr_args
+    fgr.ARGS = fgr.parse_args()
+    fgr.setup_logging("warning")
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        if setup:
+            setup()
+        start = time.time()
+        ops = run()
+        wall = time.time() - start
+    except (Exception, SystemExit) as e:
+        sys.stdout = stdout
+        print(json.dumps({"error": "%s: %s" % (type(e).__name__, e)}))
+        return
+    sys.stdout = stdout
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"wall": wall, "rss_kb": rss, "ops": ops}))
+
+
+#
+# The parent
+#
+
+def prepare_workdir(scale, args):
+    """
+    scratch directory with the map of the given scale, its topology cache
+    (written by rtgens, loaded by the mapcache case) and a routing map
+    """
+    workdir = tempfile.mkdtemp(prefix="fgr-bench-%sx-" % scale)
+    with open(os.devnull, "w") as devnull:
+        if scale == 1:
+            shutil.copy(os.path.join(HERE, "titan.map"), os.path.join(workdir, MAP))
+        else:
+            subprocess.check_call([sys.executable, os.path.join(HERE, "topogen.py"), "--scale", str(scale),
+                                   "--output", MAP], cwd=workdir, stdout=devnull)
+        subprocess.check_call([sys.executable, FGR, "rtgens", "--map", MAP], cwd=workdir,
+                              stdout=devnull, stderr=devnull)
+    return workdir
+
+def measure(case, scale, workdir, args):
+    """
+    :return: the best of args.repeat runs of case, and the largest peak RSS
+    """
+    best = None
+    cmd = [sys.executable, os.path.abspath(__file__), "--case", case, "--partition", args.partition,
+           "--numranks", str(args.numranks * scale), "--procs", str(args.procs)]
+    for i in range(args.repeat):
+        out = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.PIPE).communicate()[0]
+        lines = out.decode().strip().splitlines()
+        result = json.loads(lines[-1]) if lines else {"error": "no result"}
+        if "error" in result:
+            return result
+        if best is None or result["wall"] < best["wall"]:
+            result["rss_kb"] = max(result["rss_kb"], best["rss_kb"] if best else 0)
+            best = result
+        else:
+            best["rss_kb"] = max(result["rss_kb"], best["rss_kb"])
+    best["ops_per_sec"] = best["ops"] / best["wall"] if best["wall"] else 0.0
+    return best
+
+def compare(results, baseline, threshold, noise):
+    """
+    :return: (scale, case, what, old, new) for every regression against baseline,
+             wall time changes under noise seconds don't count
+    """
+    regressions = []
+    for scale, cases in sorted(results.items()):
+        for case, new in sorted(cases.items()):
+            old = baseline.get(scale, {}).get(case)
+            if not old or "error" in old or "error" in new:
+                continue
+            for what in ("wall", "rss_kb"):
+                if new[what] > old[what] * (1 + threshold) and (what != "wall" or new[what] - old[what] > noise):
+                    regressions.append((scale, case, what, old[what], new[what]))
+    return regressions
+
+def report(results, baseline):
+    print("%-6s %-12s %10s %10s %14s %9s" % ("scale", "case", "wall(s)", "rss(MB)", "ops/sec", "vs base"))
+    for scale, cases in sorted(results.items(), key=lambda item: int(item[0])):
+        for case in CASES:
+            if case not in cases:
+                continue
+            r = cases[case]
+            if "error" in r:
+                print("%-6s %-12s %s" % (scale + "x", case, r["error"]))
+                continue
+            old = baseline.get(scale, {}).get(case, {})
+            delta = "%+.1f%%" % ((r["wall"] / old["wall"] - 1) * 100) if old.get("wall") else ""
+            print("%-6s %-12s %10.3f %10.1f %14.1f %9s" % (scale + "x", case, r["wall"], r["rss_kb"] / 1024.0,
+                                                           r["ops_per_sec"], delta))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="FGR benchmarks")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES, help="Cases to run, default all")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Topology sizes in multiples of Titan, powers of 2, default 1 2 4 8")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each case, the best one counts, default 3")
+    parser.add_argument("--partition", default="atlas", help="Partition of the placement cases, default atlas")
+    parser.add_argument("--numranks", type=int, default=2016,
+                        help="Ranks of the placement cases per scale, default 2016")
+    parser.add_argument("--procs", type=int, default=4, help="Workers of rtgenp, default 4")
+    parser.add_argument("--output", default="bench.json", help="Results file, default bench.json")
+    parser.add_argument("--baseline", help="Results file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Slowdown or RSS growth flagged as a regression, default 0.10")
+    parser.add_argument("--noise", type=float, default=0.02,
+                        help="Slowdowns under this many seconds are never flagged, default 0.02")
+    parser.add_argument("--keep", default=False, action="store_true", help="Keep the scratch directories")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if any(scale < 1 or scale & (scale - 1) for scale in args.scales):
+        parser.error("--scales must be powers of 2")
+    return args
+
+def main():
+    args = parse_args()
+    if args.case:
+        run_case(args)
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for scale in args.scales:
+        workdir = prepare_workdir(scale, args)
+        try:
+            results[str(scale)] = dict((case, measure(case, scale, workdir, args)) for case in args.cases)
+        finally:
+            if args.keep:
+                print("Kept %s" % workdir)
+            else:
+                shutil.rmtree(workdir)
+
+    meta = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "host": platform.node(),
+            "python": platform.python_version(), "repeat": args.repeat,
+            "partition": args.partition, "numranks": args.numranks, "procs": args.procs}
+    with open(args.output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2, sort_keys=True)
+
+    report(results, baseline)
+    regressions = compare(results, baseline, args.threshold, args.noise)
+    for scale, case, what, old, new in regressions:
+        print("REGRESSION %sx %s: %s %.4g -> %.4g" % (scale, case, what, old, new))
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__": main()
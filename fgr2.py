@@ -77,6 +77,140 @@ Usage
 
     ./fgr2.py rtgens --fgrfile test.map
 
+    With numpy, the routes of all nodes are computed at once; --serial walks
+    the nodes one by one through the original search of select_grp() and
+    sort_rtr3(), much slower, but the reference for the route tables. Both
+    maps must be identical:
+
+    ./fgr2.py rtgens --serial --fgrfile reference.map
+    cmp test.map reference.map
+
+    The parallel version spreads the cabinets over a pool of workers and
+    writes the same map:
+
+    ./fgr2.py rtgenp --procs 16 --fgrfile test.map
+
+    Both also write test.map.meta, recording what the map was generated
+    from. After a router swap or a map change, only regenerate the routes
+    that changed:
+
+    ./fgr2.py rtgens --incremental --fgrfile test.map
+
+    Routers that are down are given with --failed-routers (NIDs, router
+    nodes or whole modules); their LNETs fail over to the same router node
+    of the next closest module of the sub-group, and the resulting router
+    load skew is logged:
+
+    ./fgr2.py rtgens --incremental --fgrfile test.map --failed-routers c7-2c2s0 4075
+
+    With --format binary, the routing map is written as a NID-indexed matrix
+    of router NIDs that loads in milliseconds; --fgrfile accepts either
+    format. rtexport converts between them:
+
+    ./fgr2.py rtgens --format binary --fgrfile routing.bin
+    ./fgr2.py rtexport --fgrfile routing.bin --output routing.map
+
+(7) Topology cache
+
+    The first run against a map compiles it into <map>.cache, later runs
+    memory-map the cache instead of parsing the map again. The cache is
+    rebuilt automatically when the map changes; --nocache bypasses it and
+    --mapcache chooses another location.
+
+(8) Optimal placement
+
+    ./fgr2.py placement --partition atlas --numranks 18000 --strategy optimal
+
+    Keeps the routers and OSTs of the hybrid placement, but reassigns the
+    clients to them for the lowest worst-case cost, then the lowest total
+    cost. The cost of both placements is logged. Requires numpy.
+
+(9) Link load
+
+    The cost is a hop count, it does not see flows sharing a link. Routing
+    each client -> router flow over the torus (X, then Y, then Z) shows the
+    busiest links and which ranks cross them:
+
+    ./fgr2.py placement --partition atlas --numranks 2016 --linkload
+    ./fgr2.py linkload atlas_hybrid_2016_1M.sh --top 20
+
+    --strategy balanced keeps the hybrid router order, but each router picks,
+    among its next few cheapest clients, the one whose path has the least
+    loaded busiest link.
+
+(10) Gemini sharing
+
+    Two ranks on the nodes of one Gemini share its NIC. The debug file lists
+    these collisions; --max-per-gemini 1 keeps placements off shared Geminis:
+
+    ./fgr2.py placement --partition atlas --numranks 2016 --max-per-gemini 1
+
+(11) Ranks per node
+
+    With --ranks-per-node N, each selected node runs N consecutive ranks
+    (aprun -N N), striped over consecutive OSTs behind the node's router.
+    A rank costs NIC_SHARE_COST more for every other rank on its Gemini,
+    which the hybrid and balanced strategies weigh when picking nodes, so
+    they only share Geminis once the cheaper ones are gone; add
+    --max-per-gemini N to keep nodes off shared Geminis entirely:
+
+    ./fgr2.py placement --partition atlas --numranks 8064 --ranks-per-node 4
+
+(12) Sweep
+
+    Many placements from one load of the map and routing table, one for
+    every combination of the settings; --procs forks workers for them:
+
+    ./fgr2.py sweep --partitions atlas1 atlas2 --numranks 1008 2016 \
+                    --strategies hybrid balanced --procs 4
+
+(13) Query daemon
+
+    Keeps the topology, routing map and costs loaded and answers JSON
+    requests, one per line, on a Unix socket (see QueryHandler). Changes
+    to the map or routing map are picked up automatically:
+
+    ./fgr2.py serve --socket /tmp/fgr.sock --fgrfile routing.bin
+
+    echo '{"op": "route", "nid": 4070, "lnet": 228}' | socat - UNIX-CONNECT:/tmp/fgr.sock
+    {"nid": 4070, "lnet": 228, "router": 4075, "cost": 102}
+
+(14) Synthetic topologies
+
+    topogen.py writes larger machines in the titan.map format, with their
+    router groups and OST count in <map>.routers (see do_routerfile). The
+    torus and cabinet dimensions are read from the map:
+
+    ./topogen.py --scale 4 --output big.map
+    ./fgr2.py rtgens --map big.map --fgrfile big-routing.map
+
+(15) Metrics and profiling
+
+    --metrics-out writes the time of each phase (map, routing, costs,
+    selection, shell, ...), counters and the peak RSS as JSON, --profile
+    dumps a cProfile of the sub-command into <sub-command>.prof:
+
+    ./fgr2.py placement --numranks 2016 --metrics-out metrics.json --profile
+
+(16) Cost analytics
+
+    debugclient reports client to router cost percentiles and histograms,
+    overall, per partition, per LNET and for the costliest routers. It can
+    compare two routing maps, or look at the ranks of one or two placements,
+    side by side, and save the summary arrays to a .npz:
+
+    ./fgr2.py debugclient --compare routing-failed.map --npz costs.npz
+    ./fgr2.py debugclient --placements atlas_hybrid_2016_1M.sh atlas_balanced_2016_1M.sh
+
+(17) Stripe setup
+
+    The generated script creates the files in batches, a few batches
+    running at a time, one lfs setstripe for the files of a batch that
+    share an OST, then checks every layout with lfs getstripe before IOR
+    starts:
+
+    ./fgr2.py placement --numranks 18000 --setstripe-procs 32 --setstripe-batch 64
+
 Titan Physical layout
 =====================
 
@@ -140,6 +274,9 @@ connects, <gni lnet 101>:<priority>:<router NID>
 This information is used for inbound traffic to Torus network, and which router
 to pick.
 
+The routing map, the costs and the OST tables are loaded on first use (see
+G.LAZY), so commands such as nidinfo never read the routing map.
+
 This FGR program require python 2.7 - so it doesn't run with stock version of
 RHEL or CentOS 6.x. If we do need this compatibility in the future, one
 particular change required is dictionary comprehension:
@@ -160,10 +297,21 @@ import time
 import string
 import sys
 import os
-import cPickle as pickle
-import subprocess
+import copy
+import threading
+import signal
+import SocketServer
 import operator
-import multiprocessing
+import hashlib
+import mmap
+import struct
+import itertools
+import json
+import zlib
+import functools
+import contextlib
+
+from array import array
 
 from datetime import datetime
 from collections import defaultdict
@@ -172,6 +320,8 @@ from collections import defaultdict
 
 ARGS   = None
 logger = None
+START_TIME = time.time()
+np     = None  # numpy, see import_numpy()
 
 rtrA = ["c7-2c2s0", "c23-2c1s7", "c10-2c0s0", "c3-6c0s2", "c19-6c2s2", "c14-6c1s5",
         "c7-5c2s5", "c23-5c1s2", "c10-5c0s5", "c3-1c1s4", "c19-1c0s3", "c14-1c2s3" ]
@@ -202,19 +352,55 @@ rtrI = ["c11-2c1s5", "c20-2c0s2", "c6-2c2s2", "c7-6c2s4", "c24-6c1s3", "c10-6c0s
 
 rtrALL = [rtrA, rtrB, rtrC, rtrD, rtrE, rtrF, rtrG, rtrH, rtrI]
 
-def dd_int():
-    return defaultdict(int)
+class Lazy(type):
+    """
+    Metaclass building the attributes listed in LAZY on first access,
+    through the module function named there
+    """
+
+    def __getattr__(cls, name):
+        if name not in cls.LAZY:
+            raise AttributeError(name)
+        if logger:
+            logger.debug("Loading G.%s", name)
+        globals()[cls.LAZY[name]]()
+        return type.__getattribute__(cls, name)
+
+    def unload(cls, *names):
+        """
+        drop lazy attributes, to be built again on their next access
+        """
+        for name in names:
+            if name in vars(cls):
+                delattr(cls, name)
 
 class G:
     """
     Misc global settings
     """
+    __metaclass__ = Lazy
+
+    # attribute -> function building it, on first access
+    LAZY = {
+        "RTR2LNET": "gen_rtr2lnet",
+        "COSTS": "do_fgrfile",
+        "RTR_CLIENTS": "build_rtr_clients",
+        "LNET2OST": "build_ost_tables",
+        "OST2LNET": "build_ost_tables",
+    }
 
     BASE_GNI = 100
     BASE_O2IB = 201
     BASE_LNET = 201
+    NUM_LNETS = 36  # 4 per router group
+    NUM_OSTS = 1008  # per partition
     MESH_BIAS = 24
 
+    # torus X, Y, Z, and cabinet columns, rows and cages per cabinet, of
+    # the map in use (see topology_dims)
+    DIMS = (25, 16, 24)
+    CABINETS = (25, 8, 3)
+
     CNAME = None  # used by "nodeinfo" for comparison
 
     # hold mapping from LNET to ROUTER, NID, the GNI
@@ -222,44 +408,48 @@ class G:
     LNET2NID = {}
     LNET2GNI = {}
 
+    LNET2PRIMARY = {}  # router NID the LNET would use without failures
+
+    FAILED_RTRS = set()  # router nids that are down, from --failed-routers
+
+    # routing decision tables, see build_route_tables()
+    SUBGROUP = None
+    RANKED = None
+    MODULE_NIDS = None
+    ROUTES_XY = None
+
     ###### Routers
 
+    # router modules, in groups of sub-groups of 3 modules: Titan's groups
+    # A to I unless the topology comes with a router file (see do_routerfile)
+    ROUTER_GROUPS = rtrALL
     RTR_LIST = rtrA + rtrB + rtrC + rtrD + rtrE + rtrF + rtrG + rtrH + rtrI  # all router modules
-    RTR2LNET = {}  # Router name to LNET mapping
+    # RTR2LNET: Router name to LNET mapping, lazy
 
 
     ATLAS1_RTRS = [] # Routers associated with atlas1
     ATLAS2_RTRS = [] # Routers associated with atlas2
     RID2ROUTER = defaultdict() # router id -> router object
 
-    # each router, client list ordered by costs
-    # router nid -> { client list }
-    #
-    # populated by rtr_client_costs()
-    RTR_CLIENTS = defaultdict(list)
+    # RTR_CLIENTS: each router, client list ordered by costs
+    # router nid -> { client list }, lazy
 
     ####### Client
 
-    CLIENTS = [] # all clients
-    NID2X = {}
-    NID2Y = {}
-    NID2Z = {}
-    NID2COL = {}
-    NID2CNAME = {}
+    # Node store: per-NID columns, indexed directly by NID and filled by
+    # do_mapfile(). NIDs missing from the map keep an empty cname.
+    CLIENTS = array("i")  # all clients
+    CLIENT_MASK = bytearray()  # 1 if the NID is in G.CLIENTS
+    COMPUTE = array("B")  # 1 if the NID is a compute node
+    NID2X = array("H")
+    NID2Y = array("H")
+    NID2Z = array("H")
+    NID2COL = array("H")  # cabinet column
+    NID2CNAME = []
     CNAME2NID = {}
 
-    # client_nid -> router nid -> cost
-    # = defaultdict(lambda: defaultdict(int))
-    # would be more clear, but can't pickle it
-    CLI2COSTS = defaultdict(dd_int)
-
-    # client_nid -> lnet -> router nid
-    # this is populated with do_fgrfile
-    CLI2RTID = defaultdict(dd_int)
-
-    # each router, each cost, the clients
-    # {rtr_id as key -> {cost -> [ ... clients ...]}
-    ROUTER_COSTS = defaultdict(lambda: defaultdict(list))
+    # COSTS: client x router costs and the client routing table,
+    # a CostMatrix loaded by do_fgrfile, lazy
 
     # hold currently selected client tuple
     # each tuple is (client, ost, rtr, lnet, cost)
@@ -268,12 +458,39 @@ class G:
     # client ID only, for check of duplicate
     SELECTED_CLIENT_IDS = []
 
+    # 1 if the NID has been selected, and for each router nid
+    # the position of its next candidate in G.RTR_CLIENTS
+    TAKEN = bytearray()
+    RTR_CURSOR = {}
+
+    # ranks placed on each Gemini (see gemini()), and at most how many a
+    # Gemini may take, 0 for no limit
+    GEMINI_RANKS = bytearray()
+    MAX_PER_GEMINI = 0
+
+    # ranks on each selected node (aprun -N), and the cost added to a rank
+    # for every other rank sharing its Gemini NIC
+    RANKS_PER_NODE = 1
+    NIC_SHARE_COST = 100
+
+    # balanced strategy: clients weighed per pick, and the load of each
+    # torus link (see link_hops) from the clients picked so far
+    BALANCE_WINDOW = 16
+    LINK_LOAD = None
+
+    ####### Metrics, see phase and write_metrics
+
+    PHASES = {}  # phase -> seconds spent in it
+    COUNTERS = defaultdict(int)
+
     ####### LNETS
 
-    LNET2OST = defaultdict(list) # lnet -> list of OSTs
-    OST2LNET = defaultdict(int) # {0..2015} -> lnet
+    # LNET2OST: lnet -> list of OSTs, lazy
+    # OST2LNET: {0..2015} -> lnet, lazy
 
-class Node:
+class Node(object):
+
+    __slots__ = ("col", "row", "cage", "slot", "n", "nid", "x", "y", "z", "cname")
 
     def __init__(self, cname):
 
@@ -287,7 +504,10 @@ class Node:
     def __str__(self):
         return self.cname
 
-class Router:
+class Router(object):
+
+    __slots__ = ("nid", "cname", "interface", "x", "y", "z", "partition", "lnet")
+
     def __init__(self, nid, cname, interface, x, y, z):
         self.nid = nid
         self.cname = cname
@@ -318,6 +538,43 @@ class Router:
         return self.__str__()
 
 
+class phase(object):
+    """
+    Time a phase of the run into G.PHASES, as a context manager or as a
+    function decorator. Phases are exclusive: time spent in a phase nested
+    in another one, such as a lazy load, only counts for the inner phase.
+    """
+
+    stack = []
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        now = time.time()
+        if phase.stack:
+            phase.stack[-1].stop(now)
+        self.start = now
+        phase.stack.append(self)
+
+    def __exit__(self, *exc):
+        now = time.time()
+        phase.stack.pop().stop(now)
+        if phase.stack:
+            phase.stack[-1].start = now
+
+    def stop(self, now):
+        G.PHASES[self.name] = G.PHASES.get(self.name, 0.0) + now - self.start
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with phase(self.name):
+                return func(*args, **kwargs)
+        return timed
+
+
 def dist_x(x1, x2):
     '''
     :param x1: node1
@@ -325,8 +582,9 @@ def dist_x(x1, x2):
     :return: x distrance based on TORUS
     '''
 
-    v1 = (x1 - x2 + 25) % 25
-    v2 = (x2 - x1 + 25) % 25
+    dx = G.DIMS[0]
+    v1 = (x1 - x2 + dx) % dx
+    v2 = (x2 - x1 + dx) % dx
     if (v1 < v2):
         return v1
     else:
@@ -374,6 +632,8 @@ def nodeinfo_from_file(s):
     return its NID, Cray's rca-helper can give this information
     we just lookup from provided map file
     """
+    import shlex
+    import subprocess
     cmd = "grep %s %s" % (s, ARGS.map)
     p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
@@ -403,6 +663,47 @@ def nid(s):
     nid, x, y, z = nodeinfo(s)
     return nid
 
+def compress_nids(nids):
+    """
+    Node list in the ALPS range syntax, e.g. 100-163,200-231. Only runs of
+    consecutive increasing NIDs are merged, so the order of the NIDs (the
+    rank order of aprun -L) is kept; gen_shell() lists them in NID order,
+    see order_ranks().
+
+    :param nids: NIDs, ints or strings
+    :return: the compressed list
+    """
+    ranges = []
+    first = last = None
+    for n in nids:
+        n = int(n)
+        if last is not None and n == last + 1:
+            last = n
+            continue
+        if last is not None:
+            ranges.append(str(first) if first == last else "%s-%s" % (first, last))
+        first = last = n
+    if last is not None:
+        ranges.append(str(first) if first == last else "%s-%s" % (first, last))
+    return ",".join(ranges)
+
+def expand_nids(s):
+    """
+    :param s: a node list such as 100-163,200,210-231, commas or
+              whitespace between its items
+    :return: array of its NIDs, in order
+    """
+    nids = array("i")
+    for part in re.split(r"[,\s]+", s):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            nids.extend(xrange(int(first), int(last) + 1))
+        else:
+            nids.append(int(part))
+    return nids
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="FGR Program")
@@ -410,40 +711,120 @@ def parse_args():
     parent_parser = argparse.ArgumentParser(add_help=False)
     parent_parser.add_argument("-v", "--verbose", default=False, action="store_true", help="verbose output")
     parent_parser.add_argument("--failed", type=int, nargs="+", help="A list of failed computes")
+    parent_parser.add_argument("--failed-routers", nargs="+",
+                               help="A list of failed routers: NIDs, router nodes (c7-2c2s0n2) or modules (c7-2c2s0)")
     parent_parser.add_argument("--map", default="titan.map", help="Titan map filename")
+    parent_parser.add_argument("--routers", help="Router groups of the map, default <map>.routers if it exists, "
+                                                 "else Titan's")
     parent_parser.add_argument("--username", default="fwang2", help="Provide user name")
     parent_parser.add_argument("--iorbin", default="/lustre/atlas2/test/fwang2/iotests/ior-test/IOR.posix", help="IOR bin")
     parent_parser.add_argument("--fgrfile", default="routing.map", help="Routing map")
-    parent_parser.add_argument("--nodefile",  help="Node list")
+    parent_parser.add_argument("--nodefile",  help="Node list, NIDs or ranges such as 100-163,200-231")
+    parent_parser.add_argument("--mapcache", help="Topology cache filename, default <map>.cache")
+    parent_parser.add_argument("--nocache", default=False, action="store_true",
+                               help="Always parse the map, don't use or write the topology cache")
+    parent_parser.add_argument("--metrics-out", help="Write phase timings, counters and peak RSS as JSON")
+    parent_parser.add_argument("--profile", default=False, action="store_true",
+                               help="Profile the sub-command with cProfile, into <sub-command>.prof")
     subparsers = parser.add_subparsers(help="Provide one of the sub-commands")
 
     mapinfo_parser = subparsers.add_parser("mapinfo", parents=[parent_parser], help="Generate various map")
     mapinfo_parser.set_defaults(func=main_mapinfo)
 
-    placement_parser = subparsers.add_parser("placement", parents=[parent_parser], help="Generate placement")
+    # placement options shared by placement and sweep
+    select_parser = argparse.ArgumentParser(add_help=False)
+    select_parser.add_argument("--ranks-per-node", type=int, default=1,
+                               help="Ranks on each selected node (aprun -N), default 1")
+    select_parser.add_argument("--max-per-gemini", type=int, default=0,
+                               help="At most this many ranks on the two nodes of a Gemini, default no limit")
+    select_parser.add_argument("--linkload", default=False, action="store_true",
+                               help="Report the torus link load of the placement")
+    select_parser.add_argument("--setstripe-procs", type=int, default=16,
+                               help="Stripe setup workers the script runs at a time, default 16")
+    select_parser.add_argument("--setstripe-batch", type=int, default=32,
+                               help="Files created by one stripe setup worker, default 32")
+    select_parser.add_argument("--outdir", default="",
+                               help="Directory of the generated scripts, default the current one")
+
+    partitions = ['atlas1', 'atlas2', 'atlas']
+    strategies = ["random", "hybrid", "optimal", "balanced"]
+
+    placement_parser = subparsers.add_parser("placement", parents=[parent_parser, select_parser],
+                                             help="Generate placement")
     placement_parser.add_argument("--numranks", type=int, default=1008, help="num of ranks")
-    placement_parser.add_argument("--partition", choices=['atlas1', 'atlas2', 'atlas'],
+    placement_parser.add_argument("--partition", choices=partitions,
                                   default='atlas2', help="Select partition type")
-    placement_parser.add_argument("--strategy", choices=["random", "hybrid"], default="hybrid", help="Placement type")
+    placement_parser.add_argument("--strategy", choices=strategies, default="hybrid", help="Placement type")
     placement_parser.add_argument("--stripesize", default="1M", help="Set Lustre stripe size, default 1M")
     placement_parser.set_defaults(func=main_placement)
 
+    sweep_parser = subparsers.add_parser("sweep", parents=[parent_parser, select_parser],
+                                         help="Generate placements for every combination of the settings")
+    sweep_parser.add_argument("--numranks", type=int, nargs="+", default=[1008], help="nums of ranks")
+    sweep_parser.add_argument("--partitions", choices=partitions, nargs="+", default=['atlas2'],
+                              help="Partitions")
+    sweep_parser.add_argument("--strategies", choices=strategies, nargs="+", default=["hybrid"],
+                              help="Placement types")
+    sweep_parser.add_argument("--stripesizes", nargs="+", default=["1M"], help="Lustre stripe sizes")
+    sweep_parser.add_argument("--procs", type=int, default=1,
+                              help="Placements generated in parallel, default 1")
+    sweep_parser.set_defaults(func=main_sweep)
+
     nidinfo_parser = subparsers.add_parser("nidinfo", parents=[parent_parser], help="NID explorer")
     nidinfo_parser.add_argument("nid",type=int, help="A valid NID")
     nidinfo_parser.set_defaults(func=main_nidinfo)
 
 
     rtgens_parser = subparsers.add_parser("rtgens",parents=[parent_parser], help="Generate FGR routing map (serial)")
+    rtgens_parser.add_argument("--serial", default=False, action="store_true",
+                               help="Walk the nodes one by one through select_grp() and sort_rtr3(), "
+                                    "the reference for the route tables and the vectorized engine")
+    rtgens_parser.add_argument("--format", choices=["text", "binary"], default="text",
+                               help="Routing map format, default text")
+    rtgens_parser.add_argument("--incremental", default=False, action="store_true",
+                               help="Only regenerate the routes changed since FGRFILE was generated")
     rtgens_parser.set_defaults(func=main_rtgens)
 
 
     rtgenp_parser = subparsers.add_parser("rtgenp", parents=[parent_parser], help="Generate FGR routing map (parallel)")
+    rtgenp_parser.add_argument("--procs", type=int, default=0, help="Number of workers, default one per CPU")
+    rtgenp_parser.add_argument("--serial", default=False, action="store_true",
+                               help="Workers walk their nodes one by one through select_grp() and "
+                                    "sort_rtr3(), see rtgens --serial")
+    rtgenp_parser.add_argument("--format", choices=["text", "binary"], default="text",
+                               help="Routing map format, default text")
     rtgenp_parser.set_defaults(func=main_rtgenp)
 
 
+    rtexport_parser = subparsers.add_parser("rtexport", parents=[parent_parser],
+                                            help="Convert FGRFILE between text and binary format")
+    rtexport_parser.add_argument("--output", required=True, help="Converted routing map")
+    rtexport_parser.add_argument("--format", choices=["text", "binary"], default="text",
+                                 help="Format of the converted map, default text")
+    rtexport_parser.set_defaults(func=main_rtexport)
+
     debugclient_parser = subparsers.add_parser("debugclient", parents=[parent_parser], help="Debug client")
+    debugclient_parser.add_argument("--compare", metavar="FGRFILE", help="Routing map to compare FGRFILE with")
+    debugclient_parser.add_argument("--placements", nargs="+", metavar="PLACEFILE",
+                                    help="Costs of the ranks of one or two placement scripts instead of all clients")
+    debugclient_parser.add_argument("--top", type=int, default=10, help="Number of costliest routers to show")
+    debugclient_parser.add_argument("--binwidth", type=int, default=5, help="Cost histogram bin width, default 5")
+    debugclient_parser.add_argument("--npz", help="Write the summary arrays to this .npz file")
     debugclient_parser.set_defaults(func=main_debugclient)
 
+    linkload_parser = subparsers.add_parser("linkload", parents=[parent_parser],
+                                            help="Torus link load of a placement")
+    linkload_parser.add_argument("placefile", help="Placement script written by placement")
+    linkload_parser.add_argument("--top", type=int, default=10, help="Number of busiest links to show")
+    linkload_parser.set_defaults(func=main_linkload)
+
+    serve_parser = subparsers.add_parser("serve", parents=[parent_parser],
+                                         help="Answer queries on a Unix socket, see QueryHandler")
+    serve_parser.add_argument("--socket", default="fgr.sock", help="Unix socket path, default fgr.sock")
+    serve_parser.add_argument("--poll", type=float, default=2.0,
+                              help="Seconds between checks for changed map or routing files, default 2")
+    serve_parser.set_defaults(func=main_serve)
+
     myargs = parser.parse_args()
     return myargs
 
@@ -474,104 +855,721 @@ def create_rtr_list(cname, nid, x, y, z):
         G.RID2ROUTER[nid] = r
 
 
+def route_lines(f):
+    """
+    split text routing map lines into (nid, unparsed routes)
+    """
+    for line in f:
+        nid, _, rest = line.strip().partition(" ")
+        if nid:
+            yield int(nid), rest
+
+
+def selected_routes(entries):
+    """
+    drop the entries of clients not in G.CLIENT_MASK
+    """
+    mask = G.CLIENT_MASK
+    for nid, rest in entries:
+        if nid < len(mask) and mask[nid]:
+            yield nid, rest
+
+
+def parse_routes(entries):
+    """
+    parse the routes of each entry into a list of router nids, by LNET
+    """
+    for nid, rest in entries:
+        route = [0] * G.NUM_LNETS
+        for ele in rest.split():
+            # ele takes the form of o2ib201:17736
+            # ele[4:] will cut away o2ib, with 201:17736 left
+            # we split and convert it to integer value
+            lnet, rtr = ele[4:].split(":")
+            route[int(lnet) - G.BASE_LNET] = int(rtr)
+        yield nid, route
+
+
 def do_fgrfile():
-    with open(ARGS.fgrfile, "r") as f:
-        for line in f:
-            entry = line.split()
-            nid = int(entry[0])
-            if nid not in G.CLIENTS: continue
-            rtrlist = entry[1:]
-            for ele in rtrlist:
-                # ele takes the form of o2ib201:17736
-                # ele[4:] will cut away o2ib, with 201:17736 left
-                # we split and convert it to integer value
-                lnet, rtr = [int(i) for i in ele[4:].split(":")]
-                # G.ROUTERS.add(rtr)
-                # if rtr not in G.LNET_ROUTERS[lnet]:
-                #    G.LNET_ROUTERS[lnet].append(rtr)
-
-                cost = 4 * dist(G.NID2X[nid], G.NID2X[rtr], 25)
-                cost += 8 * dist(G.NID2Y[nid], G.NID2Y[rtr], 16)
-                cost += dist(G.NID2Z[nid], G.NID2Z[rtr], 24)
-                cost += 100  # TODO: for verification only
-
-                G.ROUTER_COSTS[rtr][cost].append(nid)
-                G.CLI2COSTS[nid][rtr] = cost
-                G.CLI2RTID[nid][lnet] = rtr
+    """
+    read the routing table of G.CLIENTS and build G.COSTS from it
+    """
+    if is_binary_routing(ARGS.fgrfile):
+        with phase("routing"):
+            order, table = read_routes_binary(ARGS.fgrfile)
+            if import_numpy():
+                selected = np.frombuffer(G.CLIENT_MASK, dtype=np.uint8).astype(bool)
+                clients = order[selected[order]]
+                routes = table[clients]
+            else:
+                clients = [n for n in order if G.CLIENT_MASK[n]]
+                routes = [table[n * G.NUM_LNETS:(n + 1) * G.NUM_LNETS] for n in clients]
+    else:
+        # stream the map, parsing only the lines of clients in play
+        with phase("routing"):
+            clients = array("i")
+            routes = array("i")
+            with open(ARGS.fgrfile, "r") as f:
+                for nid, route in parse_routes(selected_routes(route_lines(f))):
+                    clients.append(nid)
+                    routes.extend(route)
+
+    G.COUNTERS["routes_parsed"] += len(clients)
+    with phase("costs"):
+        G.COSTS = CostMatrix(clients, routes)
+
+
+def import_numpy(required=False):
+    """
+    numpy is only needed by the vectorized code paths, import it on demand
+
+    :param required: exit if numpy is not available
+    :return: the numpy module, or None
+    """
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            if required:
+                print("Can't import numpy package, please install")
+                sys.exit(1)
+    return np
+
 
+def gemini(nid):
+    """
+    :return: the Gemini of nid, (x * DY + y) * DZ + z, shared by n0/n1 and
+             by n2/n3 of a slot
+    """
+    dx, dy, dz = G.DIMS
+    return (G.NID2X[nid] * dy + G.NID2Y[nid]) * dz + G.NID2Z[nid]
+
+
+def torus_dist(v1, v2, dim):
+    """
+    vectorized dist(), v1 and v2 are numpy arrays (or broadcast against
+    each other)
+    """
+    d = np.abs(v1 - v2)
+    return np.minimum(d, dim - d)
+
+
+class CostMatrix(object):
+    """
+    Client x router cost for the clients of a routing table
+
+    Rows are the clients in routing file order, columns are the routers the
+    routing table refers to, in NID order. The cost of a client using a
+    router is the weighted torus distance:
+
+        4 * dist(x) + 8 * dist(y) + dist(z) + 100
+
+    route[row][k] is the column of the router the client uses for LNET
+    BASE_LNET + k, and cost[row][k] the cost of that route: only the routed
+    pairs are kept, so the matrices grow with the number of clients, not
+    with clients x routers. With numpy, both are int matrices computed in
+    one batched pass, otherwise lists of arrays. lookup() computes the
+    cost of any pair from the coordinates.
+    """
 
+    def __init__(self, clients, routes):
+        """
+        :param clients: client nids, in routing file order
+        :param routes: routes[i] are the NUM_LNETS router nids of clients[i]
+        """
+
+        # self.clients: row -> client nid
+        # self.routers: col -> router nid
+        # self.row, self.col: nid -> row / col, -1 if not in the matrix
+        # self.weight: per axis, the weighted torus distance of a coordinate
+        # difference, for lookup()
+        self.weight = [[w * dist(0, d, dim) for d in xrange(dim)] for w, dim in zip((4, 8, 1), G.DIMS)]
+        if import_numpy():
+            self._build_numpy(clients, routes)
+        else:
+            self._build_python(clients, routes)
+
+    def _build_numpy(self, clients, routes):
+        self.clients = clients = np.asarray(clients, dtype=np.int32)
+        routes = np.asarray(routes, dtype=np.int32).reshape(-1, G.NUM_LNETS)
+        self.routers = routers = np.unique(routes)
+        self.row = np.full(len(G.NID2X), -1, dtype=np.int32)
+        self.row[clients] = np.arange(len(clients))
+        self.col = np.full(len(G.NID2X), -1, dtype=np.int32)
+        self.col[routers] = np.arange(len(routers))
+        self.route = np.searchsorted(routers, routes).astype(np.int32)
+
+        dx, dy, dz = G.DIMS
+        cost = np.full(routes.shape, 100, dtype=np.int16)
+        for coords, weight, dim in ((G.NID2X, 4, dx), (G.NID2Y, 8, dy), (G.NID2Z, 1, dz)):
+            coord = np.frombuffer(coords, dtype=np.uint16).astype(np.int16)
+            cost += weight * torus_dist(coord[clients][:, None], coord[routes], dim)
+        self.cost = cost
+
+        # for each router, its clients ordered by cost, ties in file order:
+        # one sort of the pairs on a unique (router, cost, pair) key
+        cols = self.route.ravel().astype(np.int64)
+        costs = self.cost.ravel()
+        levels = int(costs.max()) + 1 if len(costs) else 1
+        order = np.argsort((cols * levels + costs) * len(cols) + np.arange(len(cols)))
+        self._order = clients[order // G.NUM_LNETS]
+        self._bounds = np.searchsorted(cols[order], np.arange(len(routers) + 1))
+
+    def _build_python(self, clients, routes):
+        if isinstance(routes, array):
+            routes = [routes[i:i + G.NUM_LNETS] for i in xrange(0, len(routes), G.NUM_LNETS)]
+        self.clients = array("i", clients)
+        self.routers = array("i", sorted(set(rtr for route in routes for rtr in route)))
+        self.row = array("i", [-1]) * len(G.NID2X)
+        self.col = array("i", [-1]) * len(G.NID2X)
+        for i, nid in enumerate(self.clients):
+            self.row[nid] = i
+        for j, nid in enumerate(self.routers):
+            self.col[nid] = j
+
+        self.route = []
+        self.cost = []
+        buckets = [[] for rtr in self.routers]
+        for i, nid in enumerate(self.clients):
+            cols = array("i", [self.col[rtr] for rtr in routes[i]])
+            row = array("h", [self.lookup(nid, rtr) for rtr in routes[i]])
+            for cost, j in zip(row, cols):
+                buckets[j].append((cost, nid))
+            self.route.append(cols)
+            self.cost.append(row)
+
+        # sort is stable, ties stay in file order
+        self._order = []
+        self._bounds = [0]
+        for bucket in buckets:
+            bucket.sort(key=operator.itemgetter(0))
+            self._order.extend(nid for cost, nid in bucket)
+            self._bounds.append(len(self._order))
+
+    def lookup(self, client, rtr):
+        """
+        :return: cost of client using router rtr
+        """
+        wx, wy, wz = self.weight
+        return (wx[abs(G.NID2X[client] - G.NID2X[rtr])] + wy[abs(G.NID2Y[client] - G.NID2Y[rtr])] +
+                wz[abs(G.NID2Z[client] - G.NID2Z[rtr])] + 100)
+
+    def router_of(self, client, lnet):
+        """
+        :return: the router nid client uses for lnet
+        """
+        return self.routers[self.route[self.row[client]][lnet - G.BASE_LNET]]
+
+    def order(self, rtr):
+        """
+        :return: the clients routing through rtr, ordered by cost
+        """
+        j = self.col[rtr]
+        return self._order[self._bounds[j]:self._bounds[j + 1]]
+
+    def route_costs(self):
+        """
+        :return: clients x LNETs matrix, the cost of each client to reach
+                 each LNET (requires numpy)
+        """
+        return self.cost
+
+    def todict(self):
+        """
+        :return: {client nid -> {router nid -> cost}} for the routed pairs
+        """
+        costs = {}
+        routers = self.routers.tolist()
+        for i, client in enumerate(self.clients.tolist()):
+            costs[client] = dict((routers[j], int(cost)) for j, cost in zip(self.route[i], self.cost[i]))
+        return costs
+
+
+@phase("map")
 def do_mapfile():
+    """
+    Load the topology, from the compiled cache when it is still valid for
+    ARGS.map, otherwise by parsing ARGS.map (and refreshing the cache)
+    """
+    cache = topology_cache_name()
+    if cache and load_topology_cache(cache):
+        topology_dims()
+        return
+
+    nodes = []
     with open(ARGS.map, "r") as f:
         for line in f:
             nid, cname, nodetype, x, y, z = line.split()
             nid, x, y, z = map(int, [nid, x, y, z])
+            nodes.append((nid, cname, nodetype == "compute", x, y, z))
+
+    alloc_node_store(max(node[0] for node in nodes) + 1)
+    clients = []
+    for nid, cname, compute, x, y, z in nodes:
+        if compute:
+            clients.append(nid)
+            G.COMPUTE[nid] = 1
+        G.NID2CNAME[nid] = cname
+        G.NID2X[nid], G.NID2Y[nid], G.NID2Z[nid] = x, y, z
+        G.NID2COL[nid] = cname_col(cname)
+        G.CNAME2NID[cname] = nid
+
+        create_rtr_list(cname, nid, x, y, z)
+    G.CLIENTS = array("i", clients)
+    topology_dims()
+
+    if cache:
+        write_topology_cache(cache)
+
+
+def topology_dims():
+    """
+    G.DIMS and G.CABINETS from the loaded map: the torus spans the
+    coordinates in use, a row of cabinets spans 2 Y and a cage 8 Z
+    """
+    G.DIMS = dx, dy, dz = tuple(max(column) + 1 for column in (G.NID2X, G.NID2Y, G.NID2Z))
+    G.CABINETS = (max(G.NID2COL) + 1, dy // 2, dz // 8)
+    logger.debug("Torus %sx%sx%s, %s cabinets", dx, dy, dz, G.CABINETS[0] * G.CABINETS[1])
+
+
+def do_routerfile():
+    """
+    Load the router groups and the OST count, from ARGS.routers or the
+    <map>.routers written by topogen.py. The file has an "osts <count>"
+    line, the OSTs of each partition, and one line per router group with
+    its modules, sub-group by sub-group. Without one, Titan's groups and
+    1008 OSTs are used.
+    """
+    fname = ARGS.routers or ARGS.map + ".routers"
+    if not ARGS.routers and not os.path.exists(fname):
+        return
+
+    groups, osts = [], G.NUM_OSTS
+    try:
+        with open(fname, "r") as f:
+            for line in f:
+                entry = line.split()
+                if not entry or entry[0].startswith("#"):
+                    continue
+                if entry[0] == "osts":
+                    osts = int(entry[1])
+                else:
+                    groups.append(entry)
+    except (IOError, ValueError), e:
+        logger.critical("Can't read router file %s: %s", fname, e)
+        sys.exit(1)
+
+    if not groups or len(set(len(group) for group in groups)) != 1 or len(groups[0]) % 3:
+        logger.critical("%s: router groups must all have the same number of modules, a multiple of 3", fname)
+        sys.exit(1)
+
+    G.ROUTER_GROUPS = groups
+    G.RTR_LIST = [rtr for group in groups for rtr in group]
+    G.NUM_LNETS = 4 * len(groups)
+    G.NUM_OSTS = osts
+    logger.debug("%s router groups of %s modules, %s OSTs from %s", len(groups), len(groups[0]), osts, fname)
+
+
+def alloc_node_store(count):
+    """
+    size the per-NID columns of the node store for NIDs 0 .. count-1
+    """
+    G.COMPUTE = array("B", [0]) * count
+    G.NID2X, G.NID2Y, G.NID2Z, G.NID2COL = [array("H", [0]) * count for i in range(4)]
+    G.NID2CNAME = [""] * count
+    G.CNAME2NID = {}
+
+
+def cname_col(cname):
+    """
+    :return: the cabinet column of a cname such as c23-5c1s2n2
+    """
+    return int(cname[1:cname.index("-")])
+
+
+#
+# Topology cache
+#
+# Parsing titan.map is the bulk of the start-up cost of every sub-command, so
+# the parsed topology is compiled into a binary file (by default
+# <map>.cache) the first time the map is read, and memory-mapped afterwards.
+#
+# Layout, all integers little-endian:
+#
+#   header      magic, version, size/mtime/sha1 of the source map, NID count
+#   x, y, z, col  one uint16 per NID
+#   kind        one uint8 per NID (0 = no such NID, 1 = compute, 2 = service)
+#   cnames      one fixed-width, NUL padded slot per NID
+#   cname index (cname slot, nid) records sorted by cname, for lookups
+#
+# The cache is valid as long as the map has the size and mtime recorded in
+# the header; if only the mtime differs, the sha1 of the map decides.
+#
+
+TOPO_MAGIC   = "FGRTOPO1"
+TOPO_VERSION = 2
+TOPO_HEADER  = struct.Struct("<8sIQdI20s")
+TOPO_CNAME   = 16
+TOPO_INDEX   = struct.Struct("<%dsI" % TOPO_CNAME)
+
+KIND_NONE, KIND_COMPUTE, KIND_SERVICE = 0, 1, 2
+
+
+class CnameTable:
+    """
+    NID -> cname, read from the fixed-width cname slots of the cache; like
+    the list it stands in for, "" for the NIDs without a node
+    """
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __getitem__(self, nid):
+        if not 0 <= nid < self.count:
+            raise KeyError(nid)
+        start = self.offset + nid * TOPO_CNAME
+        return self.buf[start:start + TOPO_CNAME].rstrip("\0")
+
+    def __len__(self):
+        return self.count
+
+
+class CnameIndex:
+    """
+    cname -> NID, a binary search over the sorted cname index of the cache,
+    remembering the answers for repeated lookups
+    """
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.seen = {}
+
+    def _find(self, cname):
+        if cname in self.seen:
+            return self.seen[cname]
+        self.seen[cname] = nid = self._search(cname)
+        return nid
+
+    def _search(self, cname):
+        key = cname.ljust(TOPO_CNAME, "\0")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.offset + mid * TOPO_INDEX.size
+            if self.buf[start:start + TOPO_CNAME] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            slot, nid = TOPO_INDEX.unpack_from(self.buf, self.offset + lo * TOPO_INDEX.size)
+            if slot == key:
+                return nid
+        return None
+
+    def __getitem__(self, cname):
+        nid = self.seen[cname] if cname in self.seen else self._find(cname)
+        if nid is None:
+            raise KeyError(cname)
+        return nid
+
+    def __contains__(self, cname):
+        return self._find(cname) is not None
+
+    def __len__(self):
+        return self.count
+
+
+def topology_cache_name():
+    """
+    :return: path of the topology cache for ARGS.map, None if disabled
+    """
+    if ARGS.nocache:
+        return None
+    return ARGS.mapcache or ARGS.map + ".cache"
+
+
+def file_sha1(fname):
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            h.update(chunk)
+    return h.digest()
+
+
+def le_column(typecode, data):
+    """
+    build an array column from little-endian bytes
+    """
+    col = array(typecode)
+    col.fromstring(data)
+    if sys.byteorder == "big":
+        col.byteswap()
+    return col
+
+
+def write_topology_cache(cache):
+    """
+    compile the topology just parsed from ARGS.map into the cache file
+    """
+    count = len(G.NID2CNAME)
+    columns = [array("H", col) for col in (G.NID2X, G.NID2Y, G.NID2Z, G.NID2COL)]
+    kinds = array("B", [KIND_NONE]) * count
+
+    for nid, cname in enumerate(G.NID2CNAME):
+        if len(cname) > TOPO_CNAME:
+            logger.warning("cname %s too long, not caching %s", cname, ARGS.map)
+            return
+        if cname:
+            kinds[nid] = KIND_COMPUTE if G.COMPUTE[nid] else KIND_SERVICE
+
+    if sys.byteorder == "big":
+        for col in columns:
+            col.byteswap()
+
+    st = os.stat(ARGS.map)
+    header = TOPO_HEADER.pack(TOPO_MAGIC, TOPO_VERSION, st.st_size, st.st_mtime,
+                              count, file_sha1(ARGS.map))
+    index = sorted((cname, nid) for nid, cname in enumerate(G.NID2CNAME) if cname)
+
+    tmp = "%s.%d" % (cache, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(header)
+            for col in columns + [kinds]:
+                f.write(col.tostring())
+            f.write("".join(struct.pack("%ds" % TOPO_CNAME, c) for c in G.NID2CNAME))
+            f.write("".join(TOPO_INDEX.pack(c, nid) for c, nid in index))
+        os.rename(tmp, cache)
+        logger.info("Compiled %s into %s", ARGS.map, cache)
+    except (IOError, OSError), e:
+        logger.warning("Can't write topology cache %s: %s", cache, e)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def load_topology_cache(cache):
+    """
+    Populate the topology from the cache file
+
+    :return: False if the cache is missing or stale for ARGS.map
+    """
+    try:
+        f = open(cache, "rb")
+    except IOError:
+        return False
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < TOPO_HEADER.size:
+            return False
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, src_size, src_mtime, count, digest = TOPO_HEADER.unpack_from(buf, 0)
+    st = os.stat(ARGS.map)
+    if magic != TOPO_MAGIC or version != TOPO_VERSION or src_size != st.st_size or \
+            size < TOPO_HEADER.size + count * (9 + TOPO_CNAME):
+        return False
+    if src_mtime != st.st_mtime and digest != file_sha1(ARGS.map):
+        return False
+
+    offset = TOPO_HEADER.size
+    columns = []
+    for i in range(4):
+        columns.append(le_column("H", buf[offset:offset + 2 * count]))
+        offset += 2 * count
+    kinds = le_column("B", buf[offset:offset + count])
+    offset += count
+
+    nnodes = count - kinds.count(KIND_NONE)
+    if size != offset + count * TOPO_CNAME + nnodes * TOPO_INDEX.size:
+        return False
+
+    G.NID2X, G.NID2Y, G.NID2Z, G.NID2COL = columns
+    G.COMPUTE = array("B", [kind == KIND_COMPUTE for kind in kinds])
+    G.CLIENTS = array("i", [nid for nid in xrange(count) if kinds[nid] == KIND_COMPUTE])
+    G.NID2CNAME = CnameTable(buf, offset, count)
+    G.CNAME2NID = CnameIndex(buf, offset + count * TOPO_CNAME, nnodes)
 
-            if nodetype == "compute":
-                G.CLIENTS.append(nid)
-            G.NID2CNAME[nid] = cname
-            G.NID2X[nid], G.NID2Y[nid], G.NID2Z[nid] = x, y, z
-            G.CNAME2NID[cname] = nid
+    # only service nodes can be routers
+    for nid in xrange(count):
+        if kinds[nid] == KIND_SERVICE:
+            create_rtr_list(G.NID2CNAME[nid], nid, G.NID2X[nid], G.NID2Y[nid], G.NID2Z[nid])
 
-            create_rtr_list(cname, nid, x, y, z)
+    logger.debug("Loaded topology from %s", cache)
+    return True
 
 
+@phase("nodefile")
 def do_nodefile():
+    """
+    G.CLIENTS from --nodefile: NIDs or node lists (100-163,200-231), any
+    number per line, kept as a sorted array of unique NIDs
+    """
     if ARGS.nodefile:
-        G.CLIENTS = []
+        nids = array("i")
         try:
             with open(ARGS.nodefile, "r") as f:
                 for line in f:
-                    nid = int(line.strip())
-                    G.CLIENTS.append(nid)
+                    nids.extend(expand_nids(line))
         except IOError, e:
             print("Read %s error: \n %s" % (ARGS.nodefile, e))
             sys.exit(1)
+        except ValueError, e:
+            logger.critical("%s: bad node list: %s", ARGS.nodefile, e)
+            sys.exit(1)
+        G.CLIENTS = array("i", sorted(set(nids)))
+
+
+def select_clients():
+    """
+    drop --failed nodes from G.CLIENTS and build G.CLIENT_MASK
+    """
+    mask = bytearray(len(G.COMPUTE))
+    for nid in G.CLIENTS:
+        if 0 <= nid < len(mask):
+            mask[nid] = 1
+        else:
+            logger.warning("nid %s is not in %s, ignored", nid, ARGS.map)
+    for nid in ARGS.failed or []:
+        if 0 <= nid < len(mask):
+            mask[nid] = 0
+
+    G.CLIENT_MASK = mask
+    G.CLIENTS = array("i", [nid for nid in G.CLIENTS if 0 <= nid < len(mask) and mask[nid]])
+
+
+def do_failed_routers():
+    """
+    resolve --failed-routers into G.FAILED_RTRS
+    """
+    for rtr in ARGS.failed_routers or []:
+        if rtr.isdigit() and int(rtr) in G.RID2ROUTER:
+            G.FAILED_RTRS.add(int(rtr))
+        elif rtr in G.RTR_LIST:
+            G.FAILED_RTRS.update(nid(rtr + n) for n in ["n0", "n1", "n2", "n3"])
+        elif rtr in G.CNAME2NID and G.CNAME2NID[rtr] in G.RID2ROUTER:
+            G.FAILED_RTRS.add(G.CNAME2NID[rtr])
+        else:
+            logger.critical("%s is not a router", rtr)
+            sys.exit(1)
 
+    if G.FAILED_RTRS:
+        logger.info("Failed routers: %s", " ".join(map(str, sorted(G.FAILED_RTRS))))
 
-def fgr_prepare(skip_node_file=False, skip_fgr_file=False):
+
+def router_load():
+    """
+    :return: {router nid -> number of G.CLIENTS routing through it}
+    """
+    route_tables()
+    per_xy = defaultdict(int)
+    for n in G.CLIENTS:
+        per_xy[(G.NID2X[n], G.NID2Y[n])] += 1
+
+    load = dict((rtr, 0) for module in itertools.chain(*G.MODULE_NIDS) for rtr in module)
+    for (x, y), count in per_xy.iteritems():
+        for rtr in G.ROUTES_XY[x][y] or []:
+            load[rtr] += count
+    return load
+
+
+def report_router_load():
+    """
+    log how evenly the clients are spread over the healthy routers
+    """
+    load = router_load()
+    counts = [count for rtr, count in load.iteritems() if rtr not in G.FAILED_RTRS]
+    avg = float(sum(counts)) / len(counts)
+    logger.info("Router load: %s routers, clients per router min %s, avg %.1f, max %s, skew (max/avg) %.2f",
+                len(counts), min(counts), avg, max(counts), max(counts) / avg)
+
+    if G.FAILED_RTRS:
+        for rtr, count in sorted(load.iteritems(), key=operator.itemgetter(1), reverse=True)[:5]:
+            logger.info("\t%s %s%s: %s clients", rtr, G.RID2ROUTER[rtr].cname,
+                        G.RID2ROUTER[rtr].interface, count)
+
+
+def fgr_prepare(skip_node_file=False):
     """
-    pre-processing
+    pre-processing: the map and the clients in play. The routing map,
+    costs and OST tables in G are lazy, loaded on first use.
     """
+    start = time.time()
 
+    do_routerfile()
     do_mapfile()
+    do_failed_routers()
 
     if not skip_node_file:
         do_nodefile()
 
-    if ARGS.failed:
-        G.CLIENTS = list(set(G.CLIENTS) - set(ARGS.failed))
-
+    select_clients()
     logger.info("G.CLIENTS contains [%s] nids", len(G.CLIENTS))
+    G.COUNTERS["nodes"] = len(G.CNAME2NID)
+    G.COUNTERS["clients"] = len(G.CLIENTS)
 
-    if not skip_fgr_file:
-        do_fgrfile()
+    reset_selection()
+    logger.debug("Prepared in %.3f seconds, %.3f since start",
+                 time.time() - start, time.time() - START_TIME)
+
+
+@phase("rtr_clients")
+def build_rtr_clients():
+    """
+    G.RTR_CLIENTS, for each router its clients sorted by cost
+    """
+    G.RTR_CLIENTS = defaultdict(list)
+    for rtr in G.COSTS.routers.tolist():
+        G.RTR_CLIENTS[rtr] = [int(c) for c in G.COSTS.order(rtr)]
 
 
-    for ost in range(1008):
-        base = int((ost % 144) / 72) * 9
-        offset = int((ost + 4) / 8) % 9
-        lnet = 201 + base + offset
+@phase("ost_tables")
+def build_ost_tables():
+    """
+    G.LNET2OST and G.OST2LNET, every LNET's OST list in rotation order
+    """
+    G.LNET2OST = defaultdict(list)
+    G.OST2LNET = defaultdict(int)
+    ngroups = len(G.ROUTER_GROUPS)
+    for ost in range(G.NUM_OSTS):
+        base = int((ost % (16 * ngroups)) / (8 * ngroups)) * ngroups
+        offset = int((ost + 4) / 8) % ngroups
+        lnet = G.BASE_LNET + base + offset
         G.LNET2OST[lnet].append(ost)
         G.OST2LNET[ost] = lnet
 
         # atlas2
-        ost2 = ost + 1008
-        lnet += 18
+        ost2 = ost + G.NUM_OSTS
+        lnet += 2 * ngroups
         G.LNET2OST[lnet].append(ost2)
         G.OST2LNET[ost2] = lnet
 
-    # for each router, we sort clients based on cost
 
-    for rtr in G.ROUTER_COSTS.keys():
-        s_costs = sorted(G.ROUTER_COSTS[rtr].keys()) # sorted
-        for cost in s_costs:
-            G.RTR_CLIENTS[rtr] += G.ROUTER_COSTS[rtr][cost]
+def reset_selection():
+    """
+    forget the clients selected so far and restart the OST rotation, so
+    the next placement starts from the prepared topology as is
+    """
+    G.SELECTED_CLIENTS = []
+    G.SELECTED_CLIENT_IDS = []
+    G.TAKEN = bytearray(len(G.COMPUTE))
+    G.RTR_CURSOR = {}
+    dx, dy, dz = G.DIMS
+    G.GEMINI_RANKS = bytearray(dx * dy * dz)
+    G.LINK_LOAD = None
+    G.unload("LNET2OST", "OST2LNET")
 
 
 def main_mapinfo():
     fgr_prepare()
     with open("lnet2ost.map", "w") as f:
-        for lnet in range(201, 237):
+        for lnet in range(G.BASE_LNET, G.BASE_LNET + G.NUM_LNETS):
             osts = " ".join([str(i) for i in G.LNET2OST[lnet]])
             f.write("%s %s\n\n" % (lnet, osts))
     logger.info("Generate lnet2ost.map");
@@ -598,57 +1596,366 @@ def main_mapinfo():
         for rtr in G.RTR_CLIENTS.keys():
             f.write("%s %s\n" % (rtr, len(G.RTR_CLIENTS[rtr])))
 
+    import cPickle as pickle
     logger.info("Generating client 2 router cost:")
     with open("client2rtr.cost", "w") as f:
-        pickle.dump(G.CLI2COSTS, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(G.COSTS.todict(), f, pickle.HIGHEST_PROTOCOL)
 
     logger.info("Generating client routint table")
     with open("client2rtr.csv", "w") as f:
         pass
 
+def client_free(client):
+    """
+    :return: True if client is not taken and its Gemini has room left
+    """
+    if G.TAKEN[client]:
+        return False
+    return not G.MAX_PER_GEMINI or G.GEMINI_RANKS[gemini(client)] + G.RANKS_PER_NODE <= G.MAX_PER_GEMINI
+
+def take_client(client):
+    G.TAKEN[client] = 1
+    G.GEMINI_RANKS[gemini(client)] += G.RANKS_PER_NODE
+    G.SELECTED_CLIENT_IDS.append(client)
+
+def nic_share_cost(client):
+    """
+    :return: what each rank of client would cost more for the ranks already
+             on its Gemini, 0 with one rank per node (see charge_nic_sharing)
+    """
+    if G.RANKS_PER_NODE == 1:
+        return 0
+    return G.NIC_SHARE_COST * G.GEMINI_RANKS[gemini(client)]
+
 def best_client(rtr):
     """
+    The cheapest free client of rtr, counting the cost of sharing its
+    Gemini NIC with the ranks already placed there
+
     @param rtr:  a Router object
-    @return: A tuple of (selected_client, cost)
+    @return: A tuple of (selected_client, cost), None once all clients
+             of rtr are taken
     """
 
     rtr_nid = rtr.nid
-    client = None
-
-    while True:
-        client = G.RTR_CLIENTS[rtr_nid][0]
-        G.RTR_CLIENTS[rtr_nid].pop(0)
-        if client in G.SELECTED_CLIENT_IDS:
+    clients = G.RTR_CLIENTS[rtr_nid]
+    start = i = G.RTR_CURSOR.get(rtr_nid, 0)
+    while i < len(clients) and not client_free(clients[i]):
+        i += 1
+    G.RTR_CURSOR[rtr_nid] = i
+    G.COUNTERS["duplicate_skips"] += i - start
+    if i == len(clients):
+        G.COUNTERS["clients_scanned"] += i - start
+        return None
+
+    # clients are sorted by cost: past the cost of the best pick so far,
+    # no client can beat it
+    best = None
+    j = i
+    while j < len(clients):
+        client = clients[j]
+        j += 1
+        if not client_free(client):
             continue
-        else:
+        cost = G.COSTS.lookup(client, rtr_nid)
+        if best is not None and cost >= best[2]:
+            break
+        share = nic_share_cost(client)
+        if best is None or cost + share < best[2]:
+            best = (client, cost, cost + share)
+        if not share:
             break
+    G.COUNTERS["clients_scanned"] += j - start
 
-    G.SELECTED_CLIENT_IDS.append(client)
-    return client, G.CLI2COSTS[client][rtr_nid]
+    client, cost = best[:2]
+    if client == clients[i]:
+        G.RTR_CURSOR[rtr_nid] = i + 1
+    take_client(client)
+    return client, cost
+
+def balanced_client(rtr):
+    """
+    Among the next G.BALANCE_WINDOW clients of rtr by cost, pick the one
+    that shares its Gemini NIC with the fewest ranks, then whose path to
+    rtr has the least loaded busiest link, then the cheapest, and add its
+    path to G.LINK_LOAD
 
-def select_client_hybrid(rtrs, numranks):
+    @param rtr:  a Router object
+    @return: A tuple of (selected_client, cost), None once all clients
+             of rtr are taken
+    """
+    rtr_nid = rtr.nid
+    clients = G.RTR_CLIENTS[rtr_nid]
+    start = i = G.RTR_CURSOR.get(rtr_nid, 0)
+    while i < len(clients) and not client_free(clients[i]):
+        i += 1
+    G.RTR_CURSOR[rtr_nid] = i
+
+    window = []
+    while i < len(clients) and len(window) < G.BALANCE_WINDOW:
+        if client_free(clients[i]):
+            window.append(clients[i])
+        i += 1
+    G.COUNTERS["clients_scanned"] += i - start
+    G.COUNTERS["duplicate_skips"] += i - start - len(window)
+    if not window:
+        return None
+
+    links, flows = link_hops(np.array(window, dtype=np.int64), np.full(len(window), rtr_nid, dtype=np.int64))
+    peak = np.zeros(len(window), dtype=np.int64)
+    np.maximum.at(peak, flows, G.LINK_LOAD[links])
+    costs = [G.COSTS.lookup(c, rtr_nid) for c in window]
+    # a shared Gemini NIC is a busier first link than any torus link
+    share = [nic_share_cost(c) for c in window]
+    k = min(xrange(len(window)), key=lambda k: (share[k], peak[k], costs[k]))
+
+    G.LINK_LOAD[links[flows == k]] += G.RANKS_PER_NODE
+    take_client(window[k])
+    return window[k], costs[k]
+
+def charge_nic_sharing(entries, numranks):
+    """
+    add G.NIC_SHARE_COST to the cost of each of the first numranks ranks
+    of entries, in place, for every other rank on its Gemini
+    """
+    ranks = defaultdict(int)
+    for entry in entries[:numranks]:
+        ranks[gemini(entry[0])] += 1
+    for idx, (client, ost, cost, lnet, rtr) in enumerate(entries[:numranks]):
+        cost += G.NIC_SHARE_COST * (ranks[gemini(client)] - 1)
+        entries[idx] = (client, ost, cost, lnet, rtr)
+
+@phase("selection")
+def select_client_hybrid(rtrs, numranks, pick=best_client):
     # build up a list of all eligible OSTs
     # given the eligible routers
     logger.info("Eligible RTRs: %s", len(rtrs))
 
-    while len(G.SELECTED_CLIENTS) < numranks:
+    while len(G.SELECTED_CLIENTS) < numranks and rtrs:
+        exhausted = set()
         for rtr in rtrs:
-            client, cost = best_client(rtr)
-            picked_ost = G.LNET2OST[rtr.lnet].pop(0)
-            G.LNET2OST[rtr.lnet].append(picked_ost)
-            G.SELECTED_CLIENTS.append((client, picked_ost, cost, rtr.lnet, rtr))
+            picked = pick(rtr)
+            if picked is None:
+                exhausted.add(rtr.nid)
+                continue
+            # the ranks of a node stripe over consecutive OSTs of the LNET
+            client, cost = picked
+            for rank in xrange(G.RANKS_PER_NODE):
+                picked_ost = G.LNET2OST[rtr.lnet].pop(0)
+                G.LNET2OST[rtr.lnet].append(picked_ost)
+                G.SELECTED_CLIENTS.append((client, picked_ost, cost, rtr.lnet, rtr))
+        if exhausted:
+            logger.warning("%s routers ran out of clients", len(exhausted))
+            rtrs = [rtr for rtr in rtrs if rtr.nid not in exhausted]
+
+    if len(G.SELECTED_CLIENTS) < numranks:
+        logger.critical("Only %s clients available for %s ranks", len(G.SELECTED_CLIENTS), numranks)
+        sys.exit(1)
+
+    if G.RANKS_PER_NODE > 1:
+        charge_nic_sharing(G.SELECTED_CLIENTS, numranks)
 
     logger.info("Selected clients: %s", len(G.SELECTED_CLIENTS))
+    G.COUNTERS["ranks_placed"] += numranks
 
     # check for duplicate
     import collections
     logger.info("Check duplicates: %s",
               [x for x, y in collections.Counter(G.SELECTED_CLIENT_IDS).items() if y > 1])
 
-def timestamp():
-    ts = time.time()
-    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d.%H%M%S')
+def negative_cycles(W):
+    """
+    Bellman-Ford over a dense weight matrix, every node starting at
+    distance 0 (a virtual source)
 
+    :param W: n x n numpy matrix, W[u][v] the weight of u -> v, inf if none
+    :return: list of vertex-disjoint negative cycles found in the
+             predecessor graph, each a list of nodes along its edges
+    """
+    n = len(W)
+    dist = np.zeros(n)
+    pred = np.full(n, -1, dtype=int)
+    for _ in xrange(n):
+        cand = dist[:, None] + W
+        best = cand.argmin(0)
+        d = cand[best, np.arange(n)]
+        better = d < dist
+        if not better.any():
+            return []
+        dist[better] = d[better]
+        pred[better] = best[better]
+
+        # a cycle in the predecessor graph means a negative cycle
+        cycles = []
+        state = [0] * n  # 1 on the current walk, 2 done
+        for s in xrange(n):
+            walk = []
+            v = s
+            while v >= 0 and not state[v]:
+                state[v] = 1
+                walk.append(v)
+                v = pred[v]
+            if v >= 0 and state[v] == 1:
+                cycle = walk[walk.index(v):][::-1]
+                if sum(W[a][b] for a, b in zip(cycle, cycle[1:] + cycle[:1])) < 0:
+                    cycles.append(cycle)
+            for v in walk:
+                state[v] = 2
+        if cycles:
+            return cycles
+    return []
+
+
+def cancel_negative_cycles(rtr, weight, assign, nrtrs):
+    """
+    Bring a client -> router assignment to its minimum total weight,
+    keeping the number of clients of each router, by canceling negative
+    cycles in the residual graph.
+
+    The residual graph is compressed to one node per router, plus a free
+    node holding the unassigned clients: u -> v is the cheapest move of a
+    client of u over to v. Canceling cycles only changes the moves out of
+    the routers on them, so only those are recomputed.
+
+    :param rtr: clients x LNETs, the router of each route, -1 if not eligible
+    :param weight: clients x LNETs, the weight of each route
+    :param assign: router of each client, -1 if unassigned, updated in place
+    :param nrtrs: number of routers
+    """
+    free = nrtrs
+    n = nrtrs + 1
+    cur = np.where(rtr == assign[:, None], weight, 0).sum(1)
+    cur[assign < 0] = 0
+    W = np.full((n, n), np.inf)
+    client = np.full((n, n), -1, dtype=int)
+
+    # the clients of each router by weight, for the moves out of free
+    flat = np.flatnonzero(rtr.ravel() >= 0)
+    order = np.lexsort((weight.ravel()[flat], rtr.ravel()[flat]))
+    cand = flat[order] // rtr.shape[1]
+    cand_w = weight.ravel()[flat[order]]
+    bounds = np.searchsorted(rtr.ravel()[flat[order]], np.arange(n))
+
+    def moves(u):
+        if u == free:
+            return
+        members = np.flatnonzero(assign == u)
+        to = rtr[members]
+        w = weight[members] - cur[members][:, None]
+        who = np.repeat(members, to.shape[1]).reshape(to.shape)
+        ok = (to >= 0) & (to != u)
+        to, w, who = to[ok], w[ok], who[ok]
+
+        W[u] = np.inf
+        order = np.lexsort((w, to))
+        first = order[np.r_[True, to[order][1:] != to[order][:-1]]] if len(order) else order
+        W[u, to[first]] = w[first]
+        client[u, to[first]] = who[first]
+        if len(members):
+            c = members[np.argmax(cur[members])]
+            W[u, free] = -cur[c]
+            client[u, free] = c
+
+    def free_moves(vs):
+        for v in vs:
+            hit = np.flatnonzero(assign[cand[bounds[v]:bounds[v + 1]]] < 0)
+            if len(hit):
+                k = bounds[v] + hit[0]
+                W[free, v], client[free, v] = cand_w[k], cand[k]
+            else:
+                W[free, v] = np.inf
+
+    for u in xrange(nrtrs):
+        moves(u)
+    free_moves(xrange(nrtrs))
+    rounds = 0
+    while True:
+        cycles = negative_cycles(W)
+        if not cycles:
+            logger.debug("Optimal assignment after %s rounds", rounds)
+            return
+        changed = []
+        for cycle in cycles:
+            for a, b in zip(cycle, cycle[1:] + cycle[:1]):
+                c = client[a, b]
+                if b == free:
+                    assign[c], cur[c] = -1, 0
+                else:
+                    assign[c], cur[c] = b, weight[c][rtr[c] == b][0]
+                if free in (a, b):
+                    changed.append(c)
+        for u in set(itertools.chain(*cycles)):
+            moves(u)
+        if changed:
+            vs = rtr[changed].ravel()
+            free_moves(set(vs[vs >= 0].tolist()))
+        rounds += 1
+
+
+@phase("selection")
+def select_client_optimal(rtrs, numranks):
+    """
+    Start from the hybrid selection, then reassign clients to the same
+    router slots for the minimum max cost, and the minimum total cost
+    under it. Each router keeps the number of ranks hybrid gave it, so
+    the OST layout does not change.
+    """
+    select_client_hybrid(rtrs, numranks)
+    slots = G.SELECTED_CLIENTS[:numranks]
+
+    costs = G.COSTS
+    pidx = np.full(len(costs.routers), -1, dtype=int)
+    pidx[costs.col[[rtr.nid for rtr in rtrs]]] = np.arange(len(rtrs))
+    route = pidx[costs.route]
+    cost = costs.route_costs().astype(np.int64)
+    cost[route < 0] = 0
+
+    assign = np.full(len(costs.clients), -1, dtype=int)
+    for client, ost, c, lnet, rtr in slots:
+        assign[costs.row[client]] = pidx[costs.col[rtr.nid]]
+    hybrid = np.array([entry[2] for entry in slots])
+
+    # lowest max cost: no router does better than its quota-th cheapest client
+    quota = np.bincount(assign[assign >= 0], minlength=len(rtrs))
+    floor = max(np.sort(cost[route == j])[quota[j] - 1] for j in xrange(len(rtrs)) if quota[j])
+    levels = np.unique(cost[(route >= 0) & (cost >= floor) & (cost <= hybrid.max())])
+
+    # binary search the lowest feasible max cost, a route above it weighs
+    # more than any assignment under it
+    penalty = int(cost.max()) * numranks + 1
+    lo, hi = 0, len(levels) - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        trial = assign.copy()
+        cancel_negative_cycles(route, cost + penalty * (cost > levels[mid]), trial, len(rtrs))
+        if cost[route == trial[:, None]].max() <= levels[mid]:
+            assign = trial
+            hi = mid - 1
+        else:
+            lo = mid + 1
+
+    # hand the clients of each router over to its slots, cheapest first
+    picked = np.flatnonzero(assign >= 0)
+    per_rtr = defaultdict(list)
+    for c, client, j in sorted(zip(np.where(route == assign[:, None], cost, 0).sum(1)[picked].tolist(),
+                                   costs.clients[picked].tolist(), assign[picked].tolist())):
+        per_rtr[j].append((client, c))
+    for idx, (client, ost, c, lnet, rtr) in enumerate(slots):
+        client, c = per_rtr[pidx[costs.col[rtr.nid]]].pop(0)
+        G.SELECTED_CLIENTS[idx] = (client, ost, c, lnet, rtr)
+
+    optimal = np.array([entry[2] for entry in G.SELECTED_CLIENTS[:numranks]])
+    logger.info("hybrid cost: total %s, max %s", hybrid.sum(), hybrid.max())
+    logger.info("optimal cost: total %s (%+.2f%%), max %s (%+d)",
+                optimal.sum(), 100.0 * (optimal.sum() - hybrid.sum()) / hybrid.sum(),
+                optimal.max(), optimal.max() - hybrid.max())
+
+
+def timestamp():
+    ts = time.time()
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d.%H%M%S')
+
+@phase("debug")
 def debug_hybrid(ofile):
     logger.info("Writing out %s", ofile)
 
@@ -656,17 +1963,149 @@ def debug_hybrid(ofile):
 
     for entry in G.SELECTED_CLIENTS:
         client, ost, cost, lnet, rtr = entry
-        rtr2clients[rtr.nid].append(client)
+        rtr2clients[rtr.nid].append((client, cost))
 
     with open(ofile, "w") as f:
         for rtr in rtr2clients.keys():
             rtrobj = G.RID2ROUTER[rtr]
             clients = rtr2clients[rtr]
             f.write("Router %s: (%s, %s, %s)\n" % (rtr, rtrobj.x, rtrobj.y, rtrobj.z))
-            for c in clients:
+            for c, cost in clients:
                 f.write("\t Client: %s: (%s, %s, %s), cost=%s\n"
-                        %(c, G.NID2X[c], G.NID2Y[c], G.NID2Z[c], G.CLI2COSTS[c][rtr]))
+                        %(c, G.NID2X[c], G.NID2Y[c], G.NID2Z[c], cost))
+
+        # ranks sharing the NIC of a Gemini
+        per_gemini = defaultdict(list)
+        for entry in G.SELECTED_CLIENTS[:ARGS.numranks]:
+            if entry[0] not in per_gemini[gemini(entry[0])]:
+                per_gemini[gemini(entry[0])].append(entry[0])
+        shared = sorted(g for g in per_gemini if len(per_gemini[g]) > 1)
+        f.write("Gemini collisions: %s\n" % len(shared))
+        for g in shared:
+            c = per_gemini[g][0]
+            f.write("\t Gemini: (%s, %s, %s), clients=%s\n"
+                    % (G.NID2X[c], G.NID2Y[c], G.NID2Z[c], " ".join(map(str, per_gemini[g]))))
         f.close()
+    logger.info("Gemini collisions: %s", len(shared))
+
+LINK_DIRS = ["+X", "-X", "+Y", "-Y", "+Z", "-Z"]
+
+
+def link_hops(src, dst):
+    """
+    Route each src -> dst flow over the torus, X then Y then Z, the short
+    way around each ring (+ on a tie)
+
+    :param src, dst: nid arrays
+    :return: (links, flows) arrays, the link of every hop and the index of
+             the flow taking it. A link is node * 6 + LINK_DIRS index,
+             node = (x * DY + y) * DZ + z of the Gemini it leaves.
+    """
+    coords = [np.frombuffer(c, dtype=np.uint16).astype(np.int64) for c in (G.NID2X, G.NID2Y, G.NID2Z)]
+    pos = [c[src] for c in coords]
+    end = [c[dst] for c in coords]
+    dx, dy, dz = G.DIMS
+
+    links = [np.zeros(0, dtype=np.int64)]
+    flows = [np.zeros(0, dtype=np.int64)]
+    for d, dim in enumerate(G.DIMS):
+        ahead = (end[d] - pos[d]) % dim
+        up = ahead <= dim - ahead
+        hops = np.where(up, ahead, dim - ahead)
+        step = np.where(up, 1, -1)
+        for k in xrange(hops.max() if len(hops) else 0):
+            f = np.flatnonzero(hops > k)
+            node = (pos[0][f] * dy + pos[1][f]) * dz + pos[2][f]
+            links.append(node * 6 + 2 * d + (step[f] < 0))
+            flows.append(f)
+            pos[d][f] = (pos[d][f] + step[f]) % dim
+
+    return np.concatenate(links), np.concatenate(flows)
+
+
+def report_link_load(entries, top=10):
+    """
+    log the busiest torus links under a placement, with the ranks
+    crossing them
+
+    :param entries: G.SELECTED_CLIENTS tuples, in rank order
+    """
+    import_numpy(required=True)
+    src = np.array([entry[0] for entry in entries], dtype=np.int64)
+    dst = np.array([entry[4].nid for entry in entries], dtype=np.int64)
+    links, flows = link_hops(src, dst)
+    if not len(links):
+        logger.info("Link load: no client leaves its router's Gemini")
+        return
+
+    dx, dy, dz = G.DIMS
+    load = np.bincount(links, minlength=dx * dy * dz * 6)
+    used = np.flatnonzero(load)
+    logger.info("Link load: %s links used, max %s, mean %.2f, %s hops",
+                len(used), load.max(), load[used].mean(), len(links))
+    for link in used[np.argsort(-load[used], kind="mergesort")][:top]:
+        node, way = divmod(int(link), 6)
+        x, y, z = node // (dy * dz), node // dz % dy, node % dz
+        ranks = np.sort(flows[links == link])
+        logger.info("  (%s, %s, %s) %s load %s, ranks: %s",
+                    x, y, z, LINK_DIRS[way], load[link], " ".join(map(str, ranks)))
+
+
+def read_placement(fname):
+    """
+    rebuild G.SELECTED_CLIENTS tuples from a generated placement script:
+    clients from the aprun -L list, OSTs from the stripe batches (or the
+    lfs setstripe lines of older scripts)
+
+    :return: list of (client, ost, cost, lnet, rtr), in rank order, with
+             the Gemini sharing charge of scripts running several ranks
+             per node
+    """
+    def add_file(path, ost):
+        # the rank is the index of the file, file.<rank>
+        osts[int(path.rsplit(".", 1)[1])] = ost + G.NUM_OSTS if path.startswith("/lustre/atlas2/") else ost
+
+    clients = []
+    osts = {}
+    per_node = 1
+    stripes = False  # in the stripe_batches here-document
+    try:
+        with open(fname, "r") as f:
+            for line in f:
+                entry = line.split()
+                if stripes:
+                    if line.strip() == "STRIPES":
+                        stripes = False
+                    else:
+                        for stripe in entry:
+                            ost, path = stripe.split(":", 1)
+                            add_file(path, int(ost))
+                elif line.startswith("cat <<'STRIPES'"):
+                    stripes = True
+                elif line.startswith("lfs setstripe"):
+                    # one file per line, in scripts before the batched setup
+                    add_file(entry[-1], int(entry[entry.index("-i") + 1]))
+                elif line.startswith("aprun"):
+                    per_node = int(entry[entry.index("-N") + 1])
+                    clients = [c for c in expand_nids(entry[entry.index("-L") + 1]) for rank in xrange(per_node)]
+    except IOError, e:
+        print("Read %s error: \n %s" % (fname, e))
+        sys.exit(1)
+
+    if sorted(osts) != range(len(clients)):
+        logger.critical("%s: %s ranks but %s OSTs, no striping layout to route",
+                        fname, len(clients), len(osts))
+        sys.exit(1)
+
+    entries = []
+    for client, ost in zip(clients, [osts[rank] for rank in xrange(len(clients))]):
+        lnet = G.OST2LNET[ost]
+        rtr = int(G.COSTS.router_of(client, lnet))
+        entries.append((client, ost, G.COSTS.lookup(client, rtr), lnet, G.RID2ROUTER[rtr]))
+    if per_node > 1:
+        charge_nic_sharing(entries, len(entries))
+    return entries
+
 
 def current_opath(rtr, ts):
     if ARGS.partition == "atlas":
@@ -682,20 +2121,96 @@ def current_opath(rtr, ts):
 
 def gen_lfs_setstripe(fh, ts):
     """
+    Write the stripe setup stage: the files are split into batches of up
+    to ARGS.setstripe_batch, across OSTs, ARGS.setstripe_procs batches
+    running at a time. Within a batch, the files of an OST are created by
+    one lfs setstripe: files are batched OST after OST, so that happens
+    whenever ranks share OSTs. Their layouts are checked before IOR
+    starts, and both steps are timed in the job log.
+
+    The batches are lines of "<ost>:<file> ..." in the here-document of
+    stripe_batches, see read_placement.
+
     @param fh: an open file handle
     @param ts: timestamp
     """
     clients = []
+    files = {}  # (OST, directory) -> files
+    order = []
     for idx, entry in enumerate(G.SELECTED_CLIENTS[:ARGS.numranks]):
         fname = "file." + string.rjust(str(idx), 8, "0")
         client, ost, cost, lnet, rtr = entry
-        ost = ost % 1008
+        ost = ost % G.NUM_OSTS
         opath_mkdir = current_opath(rtr, ts)
-        clients.append(str(client))
-        fh.write("lfs setstripe -s %s -c 1 -i %s %s/%s\n"  % (ARGS.stripesize, ost, opath_mkdir, fname))
+        if idx % G.RANKS_PER_NODE == 0:
+            clients.append(str(client))
+        key = (ost, opath_mkdir)
+        if key not in files:
+            files[key] = []
+            order.append(key)
+        files[key].append("%s:%s/%s" % (ost, opath_mkdir, fname))
+
+    stripes = [f for key in order for f in files[key]]
+    nbatches = (len(stripes) + ARGS.setstripe_batch - 1) // ARGS.setstripe_batch
+    fh.write("# stripe setup: %s files on %s OSTs, %s batches, %s at a time\n"
+             % (len(stripes), len(order), nbatches, ARGS.setstripe_procs))
+    fh.write("stripe_batches() {\n")
+    fh.write("cat <<'STRIPES'\n")
+    for i in xrange(0, len(stripes), ARGS.setstripe_batch):
+        fh.write(" ".join(stripes[i:i + ARGS.setstripe_batch]) + "\n")
+    fh.write("STRIPES\n")
+    fh.write("}\n")
+    # one lfs setstripe per run of files on the same OST
+    fh.write("stripe_set() {\n")
+    fh.write("    local ost= files=() a\n")
+    fh.write("    for a; do\n")
+    fh.write('        if [ "${a%%:*}" != "$ost" ] && [ ${#files[@]} -gt 0 ]; then\n')
+    fh.write('            lfs setstripe -s %s -c 1 -i "$ost" "${files[@]}"\n' % ARGS.stripesize)
+    fh.write("            files=()\n")
+    fh.write("        fi\n")
+    fh.write('        ost=${a%%:*}\n')
+    fh.write('        files+=("${a#*:}")\n')
+    fh.write("    done\n")
+    fh.write("    if [ ${#files[@]} -gt 0 ]; then\n")
+    fh.write('        lfs setstripe -s %s -c 1 -i "$ost" "${files[@]}"\n' % ARGS.stripesize)
+    fh.write("    fi\n")
+    fh.write("}\n")
+    fh.write("stripe_check() {\n")
+    fh.write("    local a\n")
+    fh.write("    for a; do\n")
+    fh.write('        [ "$(lfs getstripe -i "${a#*:}")" -eq "${a%%:*}" ] 2>/dev/null || echo "${a#*:}"\n')
+    fh.write("    done\n")
+    fh.write("}\n")
+    fh.write("export -f stripe_set stripe_check\n")
+    fh.write("SECONDS=0\n")
+    fh.write("stripe_batches | xargs -P %s -L 1 bash -c 'stripe_set \"$@\"' bash\n" % ARGS.setstripe_procs)
+    fh.write('echo "Stripe setup: %s files in %s batches, ${SECONDS}s"\n' % (len(stripes), nbatches))
+    fh.write("SECONDS=0\n")
+    fh.write("bad=$(stripe_batches | xargs -P %s -L 1 bash -c 'stripe_check \"$@\"' bash)\n"
+             % ARGS.setstripe_procs)
+    fh.write('if [ -n "$bad" ]; then\n')
+    fh.write('    echo "$bad" >&2\n')
+    fh.write('    echo "Stripe setup: $(echo "$bad" | wc -l) files not on their OST" >&2\n')
+    fh.write("    exit 1\n")
+    fh.write("fi\n")
+    fh.write('echo "Stripe layouts verified, ${SECONDS}s"\n')
+    logger.info("Stripe setup: %s files on %s OSTs in %s batches, %s at a time",
+                len(stripes), len(order), nbatches, ARGS.setstripe_procs)
 
     return clients
 
+def order_ranks():
+    """
+    Renumber the selected ranks in NID order, the ranks of a node staying
+    together and in order, so that the aprun -L list compresses into
+    ranges. Each rank keeps its OST and router, only its rank and file
+    name change.
+    """
+    n = ARGS.numranks
+    G.SELECTED_CLIENTS[:n] = sorted(G.SELECTED_CLIENTS[:n], key=lambda entry: entry[0])
+
+
+@phase("shell")
 def gen_shell(ofile, clients = None):
     logger.info("Writing out %s", ofile)
     ts = timestamp()
@@ -730,31 +2245,41 @@ def gen_shell(ofile, clients = None):
             f.write("mkdir -p %s\n" % iopath1)
             f.write("mkdir -p %s\n" % iopath2)
 
-        if ARGS.strategy == "hybrid":
+        if clients is None:
+            order_ranks()
             clients = gen_lfs_setstripe(f, ts)
 
-        f.write("aprun -n %s -N 1 -L %s %s -a POSIX -b 32g -e -E -F -i 1 -k -t 1m -vv -w -D 20 -o %s\n"
-                % (ARGS.numranks, ",".join(clients), ARGS.iorbin, opath_ior))
+        f.write("aprun -n %s -N %s -L %s %s -a POSIX -b 32g -e -E -F -i 1 -k -t 1m -vv -w -D 20 -o %s\n"
+                % (ARGS.numranks, G.RANKS_PER_NODE, compress_nids(clients), ARGS.iorbin, opath_ior))
         f.close()
     # set file permission
     os.chmod(ofile, 0744)
 
 def gen_rtr2lnet():
-    global rtrALL
     LNET_BASE = 201
-    for i, rtrgroup in enumerate(rtrALL):
+    ngroups = len(G.ROUTER_GROUPS)
+    G.RTR2LNET = {}
+    for i, rtrgroup in enumerate(G.ROUTER_GROUPS):
         for j, rtr in enumerate(rtrgroup):
-            step = i % 9
+            step = i
             G.RTR2LNET[rtr + 'n0'] = LNET_BASE + step
-            G.RTR2LNET[rtr + 'n2'] = LNET_BASE + 9 + step
-            G.RTR2LNET[rtr + 'n1'] = LNET_BASE + 9 * 2 + step
-            G.RTR2LNET[rtr + 'n3'] = LNET_BASE + 9 * 3 + step
+            G.RTR2LNET[rtr + 'n2'] = LNET_BASE + ngroups + step
+            G.RTR2LNET[rtr + 'n1'] = LNET_BASE + ngroups * 2 + step
+            G.RTR2LNET[rtr + 'n3'] = LNET_BASE + ngroups * 3 + step
+
 
 
+def gen_debug_name():
+    if ARGS.strategy == "hybrid":
+        name = "%s_%s.debug" % (ARGS.partition, ARGS.numranks)
+    else:
+        name = "%s_%s_%s.debug" % (ARGS.partition, ARGS.strategy, ARGS.numranks)
+    return os.path.join(ARGS.outdir, name)
 
 def gen_ofile_name():
 
-    return "%s_%s_%s_%s.sh" % (ARGS.partition, ARGS.strategy, ARGS.numranks, ARGS.stripesize)
+    name = "%s_%s_%s_%s.sh" % (ARGS.partition, ARGS.strategy, ARGS.numranks, ARGS.stripesize)
+    return os.path.join(ARGS.outdir, name)
 
 
 
@@ -763,7 +2288,8 @@ def rule1(cy, ry):
     execute the Y-axis first selection algorithm
     """
 
-    delta_y = (cy - ry + 24) % 16 - 8
+    dy = G.DIMS[1]
+    delta_y = (cy - ry + dy + dy // 2) % dy - dy // 2
     logger.debug("rtr.Y = %s, my.Y = %s, delta_Y = %s", ry, cy, delta_y)
 
     if -1 <= delta_y <= 2:
@@ -816,7 +2342,7 @@ def select_grp(cname, rtrList):
     """
 
 
-    for i in range(4):
+    for i in range(len(rtrList) // 3):
         idx = i * 3
         rtr3 = rtrList[idx:idx + 3]
         nid = G.CNAME2NID[cname]
@@ -831,10 +2357,14 @@ def select_grp(cname, rtrList):
     return None
 
 
-def select_route(cname, lnet, rtrgrp):
+def select_route(cname, lnet, rtrgrp, xy=None):
     """
     lnet = (201 - 209)
 
+    xy is the (x, y) of cname, to look the decisions of select_grp() and
+    sort_rtr3() up from the tables of build_route_tables(); without it
+    (--serial) they run, as the reference the tables are checked against.
+
     Once a sub-group (3 router modules)'s primary router module
     are picked for the this LNET, 3 other <LNET, ROUTER> mapping are also decided.
 
@@ -862,45 +2392,135 @@ def select_route(cname, lnet, rtrgrp):
     That said, it doesn't make much sense yet: as the GNI lnet is not evenly spread
     Need to double check with the actual configuration.
     """
+    g = lnet - G.BASE_O2IB
 
     # gindex tells which subgroup is picked.
+    if xy is None:
+        gindex, rtr3 = select_grp(cname, rtrgrp) or (None, None)
+    else:
+        gindex = G.SUBGROUP[g][xy[1]]
 
-    gindex, rtrpick = select_grp(cname, rtrgrp)
-
-    if rtrpick is None:
+    if gindex is None:
         print "Can't locate router for node %s" % cname
         sys.exit(1)
 
-    rtr3 = sort_rtr3(rtrpick)
-
-
-    # c1 is the primary router module
-    c1 = rtr3[0][0:-2]  # get rid of "n0"
+    # the modules of the sub-group, closest along X first: the first one
+    # is the primary, the other two are the backups
+    if xy is None:
+        G.CNAME = cname
+        ranked = [rtr3.index(rtr[:-2]) for rtr in sort_rtr3(rtr3)]
+    else:
+        ranked = G.RANKED[g][gindex][xy[0]]
 
+    ngroups = len(G.ROUTER_GROUPS)
+    modules = G.MODULE_NIDS[g]
+    primary = gindex * 3 + ranked[0]
+    for k, interface in enumerate(["n0", "n2", "n1", "n3"]):
+        # rindex is index of the router that selected, it should be one
+        # of 0, 1, 2; it is the primary unless that router node failed
+        rindex = healthy_module(g, gindex, ranked, k) if G.FAILED_RTRS else ranked[0]
 
-    # rindex is index of the router that selected for primary
-    # it should be one of 0, 1, 2
-    rindex = rtrpick.index(c1)
+        # c1 is the selected router module
+        c1 = rtrgrp[gindex * 3 + rindex]
 
-    gni = G.BASE_GNI + (gindex * 3 + 1) + rindex
+        o2ib = lnet + k * ngroups
+        G.LNET2RTR[o2ib] = c1 + interface
+        G.LNET2NID[o2ib] = modules[gindex * 3 + rindex][k]
+        G.LNET2GNI[o2ib] = G.BASE_GNI + (gindex * 3 + 1) + rindex
+        G.LNET2PRIMARY[o2ib] = modules[primary][k]
 
 
-    G.LNET2RTR[lnet] = c1 + "n0"
-    G.LNET2NID[lnet] = nid(c1 + 'n0')
-    G.LNET2GNI[lnet] = gni
+def healthy_module(g, i, ranked, k):
+    """
+    :param ranked: module indexes within sub-group i of group g, primary first
+    :param k: which router node of the module, 0..3 for n0, n2, n1, n3
+    :return: the first module index in ranked whose k-th router node is
+             not in G.FAILED_RTRS, None if all of them failed
+    """
+    for rindex in ranked:
+        if G.MODULE_NIDS[g][i * 3 + rindex][k] not in G.FAILED_RTRS:
+            return rindex
+    return None
 
-    G.LNET2RTR[lnet + 9] = c1 + "n2"
-    G.LNET2NID[lnet + 9] = nid(c1 + 'n2')
-    G.LNET2GNI[lnet + 9] = gni
 
+def build_route_tables():
+    """
+    Tabulate select_grp() and sort_rtr3(). The sub-group only depends on the
+    Y of the compute node, the order of the modules of a sub-group only on
+    its X, so the routing decisions for the whole machine fit in:
+
+    G.SUBGROUP[g][y]        sub-group of router group g picked for Y = y,
+                            None if there is none (shouldn't happen)
+    G.RANKED[g][i][x]       indexes (0, 1, 2) of the modules of sub-group i
+                            of group g for X = x, closest first: the primary
+                            and then the backups
+    G.MODULE_NIDS[g][m]     router nids of module m of group g, ordered
+                            n0, n2, n1, n3 (LNET, LNET + 9, + 18, + 27)
+    G.ROUTES_XY[x][y]       the 36 router nids of a node at (x, y), ordered
+                            by LNET, None if there is no route
+
+    A router node in G.FAILED_RTRS is replaced in G.ROUTES_XY by the same
+    router node of the next closest module.
+    """
+    dx, dy, dz = G.DIMS
+    groups = G.ROUTER_GROUPS
+    nsub = len(groups[0]) // 3
+    G.SUBGROUP, G.RANKED, G.MODULE_NIDS = [], [], []
+
+    for g, rtrgrp in enumerate(groups):
+        n0 = [nid(rtr + "n0") for rtr in rtrgrp]
+        ry = [G.NID2Y[n0[i * 3]] for i in range(nsub)]
+        G.SUBGROUP.append([next((i for i in range(nsub) if rule1(y, ry[i])), None) for y in range(dy)])
+
+        ranked = []
+        for i in range(nsub):
+            rx = [G.NID2X[n] for n in n0[i * 3:i * 3 + 3]]
+            # sorted() is stable, equally close modules keep their order,
+            # as in sort_rtr3()
+            ranked.append([tuple(sorted(range(3), key=lambda k: dist_x(rx[k], x))) for x in range(dx)])
+        G.RANKED.append(ranked)
+
+        G.MODULE_NIDS.append([tuple(nid(rtr + n) for n in ["n0", "n2", "n1", "n3"]) for rtr in rtrgrp])
+
+        for i in range(nsub):
+            for k in range(4):
+                if healthy_module(g, i, range(3), k) is None:
+                    logger.critical("All routers of o2ib%s in %s failed", G.BASE_O2IB + g + len(groups) * k,
+                                    " ".join(rtrgrp[i * 3:i * 3 + 3]))
+                    sys.exit(1)
+
+    G.ROUTES_XY = [[None] * dy for x in range(dx)]
+    for x in range(dx):
+        for y in range(dy):
+            if None in [G.SUBGROUP[g][y] for g in range(len(groups))]:
+                continue
+            route = [0] * G.NUM_LNETS
+            for g in range(len(groups)):
+                i = G.SUBGROUP[g][y]
+                for k in range(4):
+                    rindex = healthy_module(g, i, G.RANKED[g][i][x], k)
+                    route[g + len(groups) * k] = G.MODULE_NIDS[g][i * 3 + rindex][k]
+            G.ROUTES_XY[x][y] = tuple(route)
+
+
+def route_tables():
+    """
+    build the routing tables on first use
+    """
+    if G.ROUTES_XY is None:
+        build_route_tables()
 
-    G.LNET2RTR[lnet + 18] = c1 + "n1"
-    G.LNET2NID[lnet + 18] = nid(c1 + 'n1')
-    G.LNET2GNI[lnet + 18] = gni
 
-    G.LNET2RTR[lnet + 27] = c1 + "n3"
-    G.LNET2NID[lnet + 27] = nid(c1 + 'n3')
-    G.LNET2GNI[lnet + 27] = gni
+def node_routes(nid):
+    """
+    :return: the 36 router nids of a node, ordered by LNET
+    """
+    route_tables()
+    routes = G.ROUTES_XY[G.NID2X[nid]][G.NID2Y[nid]]
+    if routes is None:
+        print "Can't locate router for node %s" % G.NID2CNAME[nid]
+        sys.exit(1)
+    return routes
 
 
 
@@ -966,7 +2586,7 @@ def gen_routes(cname):
     we call select_route() on each lnet ranging from 201 to 209.
     Each select_route will actually fill 4 mapping of <lnet, router ID>
 
-    the 3rd parameter of select_route() is a router group from rtrALL
+    the 3rd parameter of select_route() is a router group from G.ROUTER_GROUPS (rtrALL on Titan)
     rtrALL[0] - rtr group A
     rtrAll[1] - rtr group B
     ...
@@ -984,43 +2604,194 @@ def gen_routes(cname):
     primary router selection.
 
     """
-    for i in range(9):
+    # the tables also hold the router nids of the modules, which the
+    # --serial reference needs to skip failed routers
+    route_tables()
+    if getattr(ARGS, "serial", False):
+        xy = None
+    else:
+        cnid = G.CNAME2NID[cname]
+        xy = (G.NID2X[cnid], G.NID2Y[cnid])
+    for i, rtrgrp in enumerate(G.ROUTER_GROUPS):
         lnet = G.BASE_O2IB + i
-        select_route(cname, lnet, rtrALL[i])
+        select_route(cname, lnet, rtrgrp, xy)
 
 
 
-def placement_random():
+@phase("selection")
+def select_client_random(numnodes):
+    """
+    :return: numnodes clients picked at random, as strings
+    """
     random.seed()   # system time as seeds
-    clients = map(str, random.sample(G.CLIENTS, ARGS.numranks))
+    if G.MAX_PER_GEMINI:
+        candidates = list(G.CLIENTS)
+        random.shuffle(candidates)
+        clients = []
+        for c in candidates:
+            if len(clients) == numnodes:
+                break
+            if client_free(c):
+                take_client(c)
+                clients.append(c)
+        if len(clients) < numnodes:
+            logger.critical("Only %s clients available for %s nodes", len(clients), numnodes)
+            sys.exit(1)
+    else:
+        clients = random.sample(G.CLIENTS, numnodes)
+    G.COUNTERS["ranks_placed"] += numnodes * G.RANKS_PER_NODE
+    return map(str, clients)
+
+def placement_random():
+    """
+    :return: the selected clients, in NID order as order_ranks() lists the
+             other strategies
+    """
+    clients = sorted(select_client_random(ARGS.numranks // G.RANKS_PER_NODE), key=int)
     gen_shell(gen_ofile_name(), clients)
+    return clients
 
-def placement_hybrid():
-    if ARGS.partition == "atlas1":
-        select_client_hybrid(G.ATLAS1_RTRS, ARGS.numranks)
-    elif ARGS.partition == "atlas2":
-        select_client_hybrid(G.ATLAS2_RTRS, ARGS.numranks)
-    elif ARGS.partition == "atlas":
-        select_client_hybrid(G.ATLAS1_RTRS + G.ATLAS2_RTRS, ARGS.numranks)
+def partition_routers(partition):
+    """
+    :return: the routers of a partition, minus the failed ones
+    """
+    if partition == "atlas1":
+        rtrs = G.ATLAS1_RTRS
+    elif partition == "atlas2":
+        rtrs = G.ATLAS2_RTRS
+    elif partition == "atlas":
+        rtrs = G.ATLAS1_RTRS + G.ATLAS2_RTRS
     else:
-        logger.critical("Unknown partition: %s", ARGS.partition)
+        logger.critical("Unknown partition: %s", partition)
         sys.exit(1)
+    return [rtr for rtr in rtrs if rtr.nid not in G.FAILED_RTRS]
+
+def placement_hybrid():
+    select_client_hybrid(partition_routers(ARGS.partition), ARGS.numranks)
 
     # client selection is done
     gen_shell(gen_ofile_name())
 
     # debug output
-    debug_hybrid("%s_%s.debug" % (ARGS.partition, ARGS.numranks))
+    debug_hybrid(gen_debug_name())
 
-def main_placement():
-    fgr_prepare()
+def placement_balanced():
+    dx, dy, dz = G.DIMS
+    G.LINK_LOAD = np.zeros(dx * dy * dz * 6, dtype=np.int64)
+    select_client_hybrid(partition_routers(ARGS.partition), ARGS.numranks, pick=balanced_client)
+    logger.info("Max link load: %s", G.LINK_LOAD.max())
+
+    gen_shell(gen_ofile_name())
+    debug_hybrid(gen_debug_name())
+
+def placement_optimal():
+    select_client_optimal(partition_routers(ARGS.partition), ARGS.numranks)
+
+    gen_shell(gen_ofile_name())
+    debug_hybrid(gen_debug_name())
+
+def check_placement():
+    """
+    exit on placement settings in ARGS that can't work together
+    """
+    if ARGS.strategy in ("optimal", "balanced") or ARGS.linkload:
+        import_numpy(required=True)
+    if ARGS.max_per_gemini and ARGS.strategy == "optimal":
+        logger.critical("--max-per-gemini is not supported by the optimal strategy")
+        sys.exit(1)
+    if ARGS.ranks_per_node > 1 and ARGS.strategy == "optimal":
+        logger.critical("--ranks-per-node is not supported by the optimal strategy")
+        sys.exit(1)
+    if not 1 <= ARGS.ranks_per_node <= 16 or ARGS.numranks % ARGS.ranks_per_node:
+        logger.critical("--numranks must be a multiple of --ranks-per-node, which is 1 to 16")
+        sys.exit(1)
+    if ARGS.setstripe_procs < 1 or ARGS.setstripe_batch < 1:
+        logger.critical("--setstripe-procs and --setstripe-batch must be at least 1")
+        sys.exit(1)
+    if ARGS.outdir and not os.path.isdir(ARGS.outdir):
+        logger.critical("--outdir %s is not a directory", ARGS.outdir)
+        sys.exit(1)
+
+def run_placement():
+    """
+    one placement for the settings in ARGS, on the prepared topology
+
+    :return: the clients of a random placement, which leaves
+             G.SELECTED_CLIENTS empty; None for the other strategies
+    """
+    reset_selection()
+    clients = None
+    G.MAX_PER_GEMINI = ARGS.max_per_gemini
+    G.RANKS_PER_NODE = ARGS.ranks_per_node
     if ARGS.strategy == "hybrid":
         placement_hybrid()
+    elif ARGS.strategy == "optimal":
+        placement_optimal()
+    elif ARGS.strategy == "balanced":
+        placement_balanced()
     elif ARGS.strategy == "random":
-        placement_random()
+        clients = placement_random()
     else:
         raise "Shouldn't happen"
 
+    if ARGS.linkload:
+        if ARGS.strategy == "random":
+            logger.warning("Random placement has no striping layout, no link load")
+        else:
+            report_link_load(G.SELECTED_CLIENTS[:ARGS.numranks])
+    return clients
+
+def main_placement():
+    check_placement()
+    fgr_prepare()
+    run_placement()
+
+def sweep_configs():
+    """
+    :return: an ARGS copy for every partition x strategy x numranks x
+             stripe size of the sweep
+    """
+    configs = []
+    for partition, strategy, numranks, stripesize in itertools.product(
+            ARGS.partitions, ARGS.strategies, ARGS.numranks, ARGS.stripesizes):
+        config = argparse.Namespace(**vars(ARGS))
+        config.partition, config.strategy = partition, strategy
+        config.numranks, config.stripesize = numranks, stripesize
+        configs.append(config)
+    return configs
+
+def sweep_worker(config):
+    global ARGS
+    ARGS = config
+    run_placement()
+    return gen_ofile_name()
+
+def main_sweep():
+    """
+    many placements from one fgr_prepare()
+    """
+    global ARGS
+    configs = sweep_configs()
+    saved = ARGS
+    for ARGS in configs:
+        check_placement()
+    ARGS = saved
+
+    fgr_prepare()
+    start = time.time()
+    if ARGS.procs > 1:
+        import multiprocessing
+        # forked workers share the prepared topology, copy-on-write:
+        # load the lazy tables once, before forking
+        G.RTR2LNET, G.RTR_CLIENTS
+        pool = multiprocessing.Pool(processes=ARGS.procs)
+        ofiles = pool.map(sweep_worker, configs)
+        pool.close()
+        pool.join()
+    else:
+        ofiles = [sweep_worker(config) for config in configs]
+    logger.info("Swept %s placements in %.2f seconds: %s", len(ofiles), time.time() - start, " ".join(ofiles))
+
 
 def dump_routes():
 
@@ -1030,65 +2801,391 @@ def dump_routes():
 
 
 
-def record_routes(nid, f):
-    f.write("%s " % nid)
-    lnets = ["o2ib%s:%s" % (key, G.LNET2NID[key]) for key in G.LNET2NID.keys() ]
-    f.write(" ".join(lnets))
-    f.write("\n")
+def current_routes():
+    """
+    :return: the router nids gen_routes() picked, ordered by LNET
+    """
+    return [G.LNET2NID[key] for key in sorted(G.LNET2NID.keys())]
+
+
+def iter_cnames():
+    """
+    all node names, in the order the routing map is written
+    """
+    cols, rows, cages = G.CABINETS
+    for col in range(cols):
+        for row in range(rows):
+            for cage in range(cages):
+                for slot in range(8):
+                    for n in range(4):
+                        yield "c%s-%sc%ss%sn%s" % (col, row, cage, slot, n)
+
+
+@phase("routes")
+def route_matrix(cnames):
+    """
+    Vectorized gen_routes(), for many nodes at once: the routes of each
+    node are gathered from G.ROUTES_XY by its (X, Y).
+
+    :param cnames: list of node names
+    :return: (nids, routes) numpy arrays, routes[i][k] is the primary router
+             of cnames[i] for LNET BASE_O2IB + k
+    """
+    route_tables()
+    table = np.array([[r or [-1] * G.NUM_LNETS for r in col] for col in G.ROUTES_XY], dtype=np.int32)
+    X = np.frombuffer(G.NID2X, dtype=np.uint16)
+    Y = np.frombuffer(G.NID2Y, dtype=np.uint16)
+
+    nids = np.array([G.CNAME2NID[c] for c in cnames], dtype=np.int32)
+    routes = table[X[nids], Y[nids]]
+    missing = routes[:, 0] < 0
+    if missing.any():
+        print "Can't locate router for node %s" % cnames[np.argmax(missing)]
+        sys.exit(1)
+
+    return nids, routes
+
+
+def write_routes(f, nids, routes):
+    """
+    write routing map lines, a nid followed by o2ib<LNET>:<router nid> for
+    each LNET
+
+    :param nids: list of nids
+    :param routes: routes[i] is the list of router nids of nids[i], ordered
+                   by LNET
+    """
+    fmt = "%s " + " ".join("o2ib%s:%%s" % (G.BASE_O2IB + k) for k in range(G.NUM_LNETS)) + "\n"
+    for nid, route in zip(nids, routes):
+        f.write(fmt % tuple([nid] + list(route)))
+
+
+#
+# Binary routing map
+#
+# A header, the nids in routing map order, then a NID-indexed matrix of
+# NUM_LNETS router nids per NID (-1 for NIDs without routes), column k for
+# LNET base + k. All int32, little-endian; the crc32 in the header covers
+# everything after it. It is memory-mapped on load, rtexport converts it
+# to and from the text format.
+#
+
+ROUTE_MAGIC   = "FGRROUT1"
+ROUTE_VERSION = 1
+ROUTE_HEADER  = struct.Struct("<8sIIIIII")  # magic, version, base LNET, LNETs, NIDs, nids in order, crc32
+
+
+def is_binary_routing(fname):
+    with open(fname, "rb") as f:
+        return f.read(len(ROUTE_MAGIC)) == ROUTE_MAGIC
+
+
+def write_routes_binary(f, nids, routes):
+    """
+    same as write_routes(), in the binary format
+    """
+    count = max(nids) + 1
+    order = array("i", nids)
+    table = array("i", [-1]) * (count * G.NUM_LNETS)
+    for nid, route in zip(nids, routes):
+        table[nid * G.NUM_LNETS:(nid + 1) * G.NUM_LNETS] = array("i", route)
+    if sys.byteorder == "big":
+        order.byteswap()
+        table.byteswap()
+
+    payload = order.tostring() + table.tostring()
+    f.write(ROUTE_HEADER.pack(ROUTE_MAGIC, ROUTE_VERSION, G.BASE_O2IB, G.NUM_LNETS,
+                              count, len(order), zlib.crc32(payload) & 0xffffffff))
+    f.write(payload)
+
+
+def read_routes_binary(fname):
+    """
+    :return: (order, table), the nids in routing map order and the
+             NID-indexed route matrix. With numpy, these are arrays over the
+             memory-mapped file (table is NIDs x LNETs); without, array
+             columns (table is flat).
+    """
+    with open(fname, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, base, lnets, count, norder, crc = ROUTE_HEADER.unpack_from(buf, 0)
+    start = ROUTE_HEADER.size
+    if magic != ROUTE_MAGIC or version != ROUTE_VERSION or \
+            len(buf) != start + 4 * (norder + count * lnets):
+        logger.critical("%s is not a valid binary routing map", fname)
+        sys.exit(1)
+    if base != G.BASE_O2IB or lnets != G.NUM_LNETS:
+        logger.critical("%s has LNETs %s..%s, expected %s..%s", fname, base, base + lnets - 1,
+                        G.BASE_O2IB, G.BASE_O2IB + G.NUM_LNETS - 1)
+        sys.exit(1)
+    if zlib.crc32(buf[start:]) & 0xffffffff != crc:
+        logger.critical("%s: checksum mismatch", fname)
+        sys.exit(1)
+
+    if import_numpy():
+        order = np.frombuffer(buf, dtype="<i4", count=norder, offset=start)
+        table = np.frombuffer(buf, dtype="<i4", count=count * lnets, offset=start + 4 * norder)
+        return order, table.reshape(count, lnets)
+
+    order = le_column("i", buf[start:start + 4 * norder])
+    table = le_column("i", buf[start + 4 * norder:])
+    return order, table
+
+
+def load_routes(fname):
+    """
+    read a routing map in either format
+
+    :return: (nids, routes) lists, in routing map order
+    """
+    if is_binary_routing(fname):
+        order, table = read_routes_binary(fname)
+        if import_numpy():
+            return order.tolist(), table[order].tolist()
+        return list(order), [list(table[n * G.NUM_LNETS:(n + 1) * G.NUM_LNETS]) for n in order]
+
+    nids, routes = [], []
+    with open(fname, "r") as f:
+        for nid, route in parse_routes(route_lines(f)):
+            nids.append(nid)
+            routes.append(route)
+    return nids, routes
+
+
+@phase("write_routes")
+def save_routes(fname, nids, routes, binary):
+    """
+    (re)write a routing map, through a temporary file
+    """
+    tmp = "%s.%d" % (fname, os.getpid())
+    with open(tmp, "wb" if binary else "w") as f:
+        if binary:
+            write_routes_binary(f, nids, routes)
+        else:
+            write_routes(f, nids, routes)
+    os.rename(tmp, fname)
 
 
 def main_rtgens():
     """
-    serialized version
+    serialized version, vectorized with numpy unless --serial is given
     TODO: still don't think G.CNAME is needed
     """
-    fgr_prepare(skip_fgr_file=True)
+    fgr_prepare()
+    if ARGS.incremental and update_routes():
+        return
+
     logger.info("Generating FGRFILE")
-    f = open(ARGS.fgrfile, "w")
-    for col in range(25):
-        logger.info("\tprocessing %s of 25 columns", col+1)
-        for row in range(8):
-            for cage in range(3):
-                for slot in range(8):
-                    for n in range(4):
-                        G.CNAME = "c%s-%sc%ss%sn%s" % (col, row, cage, slot, n)
-                        gen_routes(G.CNAME)
-                        record_routes(nid(G.CNAME), f)
-    f.close()
-
-
-def gen_routes_worker(row):
-    name = multiprocessing.current_process().name
-    logger.info("%s generating FGRFILE for row %s", name, row)
-    fgr_partial = "%s.%02d" % (ARGS.fgrfile, row)
-    f = open(fgr_partial, "w")
-    for col in range(25):
-        for cage in range(3):
-            for slot in range(8):
-                for n in range(4):
-                    G.CNAME = "c%s-%sc%ss%sn%s" % (col, row, cage, slot, n)
-                    G.CNODE = str2node(G.CNAME)
-                    gen_routes(G.CNODE)
-                    record_routes(f)
-        percent = (col + 1) * 4
-        logger.info("Worker %s: %d%% done", name, percent)
-    f.close()
-    logger.info("Finish generating routes for row %s", row)
+    if not ARGS.serial and import_numpy():
+        nids, routes = route_matrix(list(iter_cnames()))
+        nids, routes = nids.tolist(), routes.tolist()
+    else:
+        nids, routes = [], []
+        with phase("routes"):
+            for col, cnames in itertools.groupby(iter_cnames(), cname_col):
+                logger.info("\tprocessing %s of %s columns", col+1, G.CABINETS[0])
+                for cname in cnames:
+                    G.CNAME = cname
+                    gen_routes(G.CNAME)
+                    nids.append(nid(G.CNAME))
+                    routes.append(current_routes())
+
+    save_routes(ARGS.fgrfile, nids, routes, ARGS.format == "binary")
+    logger.info("Generated routes for %s nodes", len(nids))
+    write_routing_meta(routing_state())
+    report_router_load()
+
+
+#
+# Incremental routing map regeneration
+#
+# Next to the routing map, <fgrfile>.meta records what it was generated
+# from: the router groups, G.RTR2LNET, the (nid, X, Y) of the node on each
+# line, and G.ROUTES_XY. A node's routes only depend on its (X, Y) and the
+# tables, so after a router or topology change only the lines of nodes that
+# moved, or that sit at an (X, Y) whose routes changed, are regenerated.
+#
+
+def routing_state():
+    """
+    :return: what the routing map is generated from, see above
+    """
+    route_tables()
+    nids = [nid(cname) for cname in iter_cnames()]
+    return {
+        "map_sha1": file_sha1(ARGS.map).encode("hex"),
+        "groups": G.ROUTER_GROUPS,
+        "rtr2lnet": G.RTR2LNET,
+        "nids": nids,
+        "xs": [G.NID2X[n] for n in nids],
+        "ys": [G.NID2Y[n] for n in nids],
+        "routes_xy": [[list(r) if r else None for r in col] for col in G.ROUTES_XY],
+    }
+
+
+def write_routing_meta(state):
+    tmp = "%s.meta.%d" % (ARGS.fgrfile, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.rename(tmp, ARGS.fgrfile + ".meta")
+
+
+def read_routing_meta():
+    """
+    :return: the state recorded for ARGS.fgrfile, None if there is none
+    """
+    try:
+        with open(ARGS.fgrfile + ".meta", "r") as f:
+            return json.load(f)
+    except (IOError, ValueError), e:
+        logger.debug("Can't read %s.meta: %s", ARGS.fgrfile, e)
+        return None
 
 
-def main_rtgenp():
-    """using multiprocessing"""
-    fgr_prepare(skip_fgr_file=True)
-    jobs = []
-    for i in range(8):
-        p = multiprocessing.Process(target=gen_routes_worker, args=(i,))
-        jobs.append(p)
-        p.start()
+def update_routes():
+    """
+    Regenerate only the routes of ARGS.fgrfile affected by changes in the
+    map or router groups since it was written.
 
-    for job in jobs:
-        job.join()
+    :return: False if the routing map has to be regenerated from scratch
+    """
+    old = read_routing_meta()
+    if old is None or not os.path.exists(ARGS.fgrfile):
+        logger.info("No previous state for %s, regenerating all routes", ARGS.fgrfile)
+        return False
 
-    logger.info("All jobs are finished, cats all output into a single one")
+    new = routing_state()
+    nids, routes = load_routes(ARGS.fgrfile)
+    if len(nids) != len(new["nids"]) or len(old["nids"]) != len(new["nids"]):
+        logger.info("Node count changed, regenerating all routes")
+        return False
+
+    for g, (before, after) in enumerate(zip(old["groups"], new["groups"])):
+        if before != after:
+            logger.info("Router group %s: removed %s, added %s", string.uppercase[g],
+                        " ".join(sorted(set(before) - set(after))) or "none",
+                        " ".join(sorted(set(after) - set(before))) or "none")
+    changed = [rtr for rtr in new["rtr2lnet"] if old["rtr2lnet"].get(rtr) != new["rtr2lnet"][rtr]]
+    if changed:
+        logger.info("LNET of %s router nodes changed", len(changed))
+    if old["map_sha1"] != new["map_sha1"]:
+        logger.info("%s changed", ARGS.map)
+
+    changed_xy = set()
+    for x, col in enumerate(new["routes_xy"]):
+        for y, xy_routes in enumerate(col):
+            if x >= len(old["routes_xy"]) or y >= len(old["routes_xy"][x]) or \
+                    old["routes_xy"][x][y] != xy_routes:
+                changed_xy.add((x, y))
+
+    affected = [i for i, n in enumerate(new["nids"])
+                if (new["xs"][i], new["ys"][i]) in changed_xy or
+                (old["nids"][i], old["xs"][i], old["ys"][i]) != (n, new["xs"][i], new["ys"][i])]
+
+    for i in affected:
+        nids[i] = new["nids"][i]
+        routes[i] = node_routes(nids[i])
+
+    if affected:
+        save_routes(ARGS.fgrfile, nids, routes, is_binary_routing(ARGS.fgrfile))
+    write_routing_meta(new)
+
+    logger.info("Updated %s of %s routes in %s", len(affected), len(nids), ARGS.fgrfile)
+    report_router_load()
+    return True
+
+
+def cabinet_chunks():
+    """
+    split the nodes into one chunk per cabinet, the chunks are in routing
+    map order
+
+    :return: list of (cabinet, [cnames])
+    """
+    cabinet = lambda cname: cname[:cname.index("c", 1)]
+    return [(cab, list(cnames)) for cab, cnames in itertools.groupby(iter_cnames(), cabinet)]
+
+
+def gen_routes_chunk(cnames):
+    """
+    :return: (nids, routes) lists for cnames
+    """
+    if not ARGS.serial and import_numpy():
+        nids, routes = route_matrix(cnames)
+        return nids.tolist(), routes.tolist()
+
+    nids, routes = [], []
+    for cname in cnames:
+        G.CNAME = cname
+        gen_routes(cname)
+        nids.append(nid(cname))
+        routes.append(current_routes())
+    return nids, routes
+
+
+def gen_routes_worker(chunk):
+    import multiprocessing
+    cabinet, cnames = chunk
+    return (multiprocessing.current_process().name,) + gen_routes_chunk(cnames)
+
+
+def main_rtgenp():
+    """
+    using multiprocessing: a pool of ARGS.procs workers, each generating the
+    routes of one cabinet at a time. Results are written out in cabinet
+    order as they come back, so the map is identical to the one of rtgens.
+    """
+    import multiprocessing
+    fgr_prepare()
+    chunks = cabinet_chunks()
+    procs = ARGS.procs or multiprocessing.cpu_count()
+    logger.info("Generating FGRFILE with %s workers, %s cabinets", procs, len(chunks))
+
+    done = defaultdict(int)  # worker -> cabinets
+    step = max(len(chunks) // 10, 1)
+    binary = ARGS.format == "binary"
+    all_nids, all_routes = [], []
+    tmp = "%s.%d" % (ARGS.fgrfile, os.getpid())
+    pool = multiprocessing.Pool(procs)
+    try:
+        f = None if binary else open(tmp, "w")
+        with phase("routes"):
+            for i, (name, nids, routes) in enumerate(pool.imap(gen_routes_worker, chunks)):
+                if binary:
+                    all_nids += nids
+                    all_routes += routes
+                else:
+                    write_routes(f, nids, routes)
+                done[name] += 1
+                if (i + 1) % step == 0 or i + 1 == len(chunks):
+                    logger.info("\t%d%% done, cabinets per worker: %s", (i + 1) * 100 / len(chunks),
+                                " ".join("%s=%s" % (w, n) for w, n in sorted(done.items())))
+        if f:
+            f.close()
+            os.rename(tmp, ARGS.fgrfile)
+        pool.close()
+    except:
+        pool.terminate()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        pool.join()
+
+    if binary:
+        save_routes(ARGS.fgrfile, all_nids, all_routes, binary)
+    write_routing_meta(routing_state())
+    logger.info("All jobs are finished, routes written to %s", ARGS.fgrfile)
+    report_router_load()
+
+def main_rtexport():
+    """
+    convert a routing map between the text and the binary format
+    """
+    nids, routes = load_routes(ARGS.fgrfile)
+    save_routes(ARGS.output, nids, routes, ARGS.format == "binary")
+    logger.info("Wrote %s routes to %s", len(nids), ARGS.output)
 
 def main_nidinfo():
     """
@@ -1096,11 +3193,11 @@ def main_nidinfo():
     """
     fgr_prepare()
     nid = ARGS.nid
-    G.CNAME = G.NID2CNAME[nid]
 
-    if not nid in G.CLIENTS:
+    if not 0 <= nid < len(G.COMPUTE) or not G.COMPUTE[nid] or not G.CLIENT_MASK[nid]:
         print("%s is not a compute node!" % nid)
         sys.exit(1)
+    G.CNAME = G.NID2CNAME[nid]
 
     print("\nNID = %s, cname = %s, (%s, %s, %s)" %
           (nid, G.NID2CNAME[nid], G.NID2X[nid], G.NID2Y[nid], G.NID2Z[nid]))
@@ -1110,36 +3207,556 @@ def main_nidinfo():
     gen_routes(G.NID2CNAME[nid])
     dump_routes()
 
-def main_debugclient():
+    failover = [lnet for lnet in sorted(G.LNET2NID) if G.LNET2NID[lnet] != G.LNET2PRIMARY[lnet]]
+    if failover:
+        print("\nFailed over:\n")
+        for lnet in failover:
+            print("o2ib%s: %s failed, using %s" % (lnet, G.LNET2PRIMARY[lnet], G.LNET2NID[lnet]))
+
+#
+# Cost analytics of debugclient
+#
+# A set of costs is three flat arrays: the cost of each client/LNET pair
+# (or rank) and its LNET and router. Statistics are computed per group of
+# entries (a partition, an LNET, a router) in one pass: the entries are
+# sorted by (group, cost) and the percentiles read at each group's offsets.
+#
+
+COST_STATS = ("count", "min", "avg", "p50", "p95", "p99", "max")
+
+
+def group_stats(groups, values):
+    """
+    :param groups: int array, the group of each value
+    :param values: int array, costs
+    :return: (keys, stats), the distinct groups and for each of them a row
+             of COST_STATS over its values
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return groups, np.zeros((0, len(COST_STATS)))
+
+    # one sort of (group, value) packed into an int64
+    vmin, gmin = values.min(), groups.min()
+    levels = values.max() - vmin + 1
+    packed = np.sort((groups - gmin) * levels + (values - vmin))
+    groups = packed // levels + gmin
+    values = (packed % levels + vmin).astype(np.float64)
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    keys = groups[starts]
+    counts = np.diff(np.r_[starts, len(groups)])
+    pos = starts[:, None] + (counts[:, None] - 1) * np.array([0.50, 0.95, 0.99])[None, :]
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    pct = values[lo] + (values[hi] - values[lo]) * (pos - lo)
+    sums = np.add.reduceat(values, starts)
+    ends = starts + counts - 1
+    stats = np.column_stack([counts, values[starts], sums / counts, pct, values[ends]])
+    return keys, stats
+
+
+def group_histograms(groups, values, edges, keys=None):
+    """
+    :param keys: the distinct groups, sorted, if already known
+    :return: (keys, counts), counts[i] the histogram over edges of the
+             values of group keys[i]
+    """
+    if keys is None:
+        keys = np.unique(groups)
+    index = np.searchsorted(keys, groups)
+    bins = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+    nbins = len(edges) - 1
+    counts = np.bincount(index * nbins + bins, minlength=len(keys) * nbins)
+    return keys, counts.reshape(len(keys), nbins)
+
+
+def routing_costs(costs):
     """
-    compute client to router cost in FGRFILE
+    :param costs: a CostMatrix
+    :return: (cost, lnet, router) of every client/LNET pair
     """
+    route = np.asarray(costs.route)
+    lnets = np.tile(np.arange(G.BASE_LNET, G.BASE_LNET + G.NUM_LNETS), len(route))
+    return costs.route_costs().ravel(), lnets, np.asarray(costs.routers)[route].ravel()
+
+
+def placement_costs(fname):
+    """
+    :return: (cost, lnet, router) of every rank of a placement script
+    """
+    entries = read_placement(fname)
+    return tuple(np.array(column, dtype=np.int64) for column in
+                 zip(*[(cost, lnet, rtr.nid) for client, ost, cost, lnet, rtr in entries]))
+
+
+def cost_summary(cost, lnet, router, edges):
+    """
+    :return: {name -> array}, the statistics of a set of costs: overall,
+             per partition, per LNET and per router, and their histograms
+    """
+    cost = np.asarray(cost, dtype=np.int64)
+    partition = (lnet >= G.BASE_LNET + G.NUM_LNETS // 2).astype(np.int64)  # 0 atlas1, 1 atlas2
+    summary = {"edges": edges}
+    summary["all"] = group_stats(np.zeros(len(cost), dtype=np.int64), cost)[1][0]
+    summary["all_hist"] = np.histogram(cost, bins=edges)[0]
+    for name, groups in (("partition", partition), ("lnet", lnet), ("router", router)):
+        summary[name + "s"], summary[name + "_stats"] = group_stats(groups, cost)
+        summary[name + "_hist"] = group_histograms(groups, cost, edges, summary[name + "s"])[1]
+    return summary
+
+
+def stats_line(label, rows):
+    """
+    one line of COST_STATS, for one summary or side by side for two
+    """
+    if len(rows) == 1:
+        return "%-14s %8d" % (label, rows[0][0]) + "".join(" %7.1f" % v for v in rows[0][1:])
+    a, b = rows
+    return "%-14s" % label + "".join(" %7.1f %7.1f %+6.1f" % (a[k], b[k], b[k] - a[k]) for k in range(2, 7))
+
+
+def print_summary(summaries, labels, top):
+    names = dict(enumerate(["atlas1", "atlas2"]))
+    if len(summaries) == 1:
+        print("%-14s %8s" % ("", "count") + "".join(" %7s" % stat for stat in COST_STATS[1:]))
+    else:
+        print("%s -> %s" % tuple(labels))
+        print("%-14s" % "" + "".join(" %7s %7s %6s" % (stat, "", "") for stat in COST_STATS[2:]))
+
+    def rows(name, key):
+        found = []
+        for summary in summaries:
+            idx = np.flatnonzero(summary[name + "s"] == key)
+            if not len(idx):
+                return None
+            found.append(summary[name + "_stats"][idx[0]])
+        return found
+
+    print(stats_line("all", [summary["all"] for summary in summaries]))
+    for key in sorted(set(int(k) for summary in summaries for k in summary["partitions"])):
+        found = rows("partition", key)
+        if found:
+            print(stats_line(names[key], found))
+    for key in sorted(set(int(k) for summary in summaries for k in summary["lnets"])):
+        found = rows("lnet", key)
+        if found:
+            print(stats_line("o2ib%s" % key, found))
+
+    edges = summaries[0]["edges"]
+    print("\nCost histogram:")
+    for i in range(len(edges) - 1):
+        counts = [summary["all_hist"][i] for summary in summaries]
+        if any(counts):
+            print("  %5d-%-5d" % (edges[i], edges[i + 1] - 1) + "".join(" %9d" % c for c in counts))
+
+    for label, summary in zip(labels, summaries):
+        stats = summary["router_stats"]
+        worst = np.lexsort((-stats[:, 2], -stats[:, 5]))[:top]
+        print("\nCostliest routers of %s, by p99:" % label)
+        for i in worst:
+            rtr = int(summary["routers"][i])
+            print("  %6d %-14s o2ib%-4s count=%d avg=%.1f p50=%.1f p95=%.1f p99=%.1f max=%d" %
+                  ((rtr, G.NID2CNAME[rtr], G.RID2ROUTER[rtr].lnet, stats[i][0]) + tuple(stats[i][2:])))
+
+
+def save_summary(fname, summaries, labels):
+    """
+    write the summaries to a .npz, the arrays of the i-th one prefixed by
+    "<i>_", with COST_STATS naming the columns of the *_stats arrays
+    """
+    arrays = {"labels": np.array(labels), "stats": np.array(COST_STATS)}
+    for i, summary in enumerate(summaries):
+        for name, value in summary.items():
+            arrays["%s_%s" % (i, name)] = value
+    np.savez_compressed(fname, **arrays)
+    logger.info("Summary written to %s", fname)
+
+
+def load_costs(fgrfile):
+    """
+    :return: the CostMatrix of another routing map, G.COSTS is left as is
+    """
+    saved, costs = ARGS.fgrfile, G.COSTS
+    ARGS.fgrfile = fgrfile
     try:
-        import numpy as np
-    except:
-        print("Can't import numpy package, please install")
+        G.unload("COSTS")
+        return G.COSTS
+    finally:
+        ARGS.fgrfile, G.COSTS = saved, costs
+
+
+def main_debugclient():
+    """
+    client to router costs in FGRFILE: statistics overall, per partition,
+    per LNET and per router, and histograms. --compare puts those of another
+    routing map side by side, --placements looks at the ranks of one or two
+    placement scripts instead of all clients.
+    """
+    import_numpy(required=True)
+    if ARGS.placements and (len(ARGS.placements) > 2 or ARGS.compare):
+        logger.critical("--placements takes one or two scripts, and no --compare")
         sys.exit(1)
 
     fgr_prepare()
-    all_client_costs = []
-    per_client_costs = []
-    for nid in G.CLIENTS:
-        tally = 0
-        for lnet in range(201,237):
-            rid = G.CLI2RTID[nid][lnet]
-            all_client_costs.append(G.CLI2COSTS[nid][rid])
-            tally += G.CLI2COSTS[nid][rid]
-        per_client_costs.append(tally)
+    if ARGS.placements:
+        labels = ARGS.placements
+        sets = [placement_costs(fname) for fname in labels]
+    else:
+        labels = [ARGS.fgrfile]
+        sets = [routing_costs(G.COSTS)]
+        y = sets[0][0]
+        x = y.reshape(-1, G.NUM_LNETS).sum(axis=1)
+
+        # compute avg, min, max
+        print("Per client: min = {:.2f}, max = {:.2f}, avg = {:.2f}, std = {:.2f}".
+              format(x.min(), x.max(), x.mean(), x.std()))
+
+        print("All client: min = {:.2f}, max = {:.2f}, avg = {:.2f}, std = {:.2f}".
+              format(y.min(), y.max(), y.mean(), y.std()))
+
+        if ARGS.compare:
+            other = load_costs(ARGS.compare)
+            labels.append(ARGS.compare)
+            sets.append(routing_costs(other))
+            compare_routes(G.COSTS, other)
+    print("")
+
+    low = min(int(cost.min()) for cost, lnet, router in sets)
+    high = max(int(cost.max()) for cost, lnet, router in sets)
+    low -= low % ARGS.binwidth
+    edges = np.arange(low, high + ARGS.binwidth + 1, ARGS.binwidth)
+    summaries = [cost_summary(cost, lnet, router, edges) for cost, lnet, router in sets]
+    print_summary(summaries, labels, ARGS.top)
+    if ARGS.npz:
+        save_summary(ARGS.npz, summaries, labels)
+
+
+def compare_routes(a, b):
+    """
+    print how the routes and costs differ for the clients in both
+    routing maps
+    """
+    common = np.intersect1d(a.clients, b.clients)
+    ra, rb = a.row[common], b.row[common]
+    routers_a = np.asarray(a.routers)[a.route[ra]]
+    routers_b = np.asarray(b.routers)[b.route[rb]]
+    cost_a = a.cost[ra]
+    cost_b = b.cost[rb]
+    moved = routers_a != routers_b
+    print("Clients in both maps: %s, routes changed: %s of %s (%s clients)" %
+          (len(common), moved.sum(), moved.size, moved.any(axis=1).sum()))
+    print("Route costs: %s lower, %s higher, total %+d" %
+          ((cost_b < cost_a).sum(), (cost_b > cost_a).sum(), int(cost_b.sum()) - int(cost_a.sum())))
+
+
+def main_linkload():
+    """
+    torus link load of a generated placement
+    """
+    import_numpy(required=True)
+    fgr_prepare()
+    report_link_load(read_placement(ARGS.placefile), ARGS.top)
+
+
+class RWLock(object):
+    """
+    Many readers or one writer. A waiting writer holds off new readers,
+    so a reload isn't starved by a stream of queries.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writers = 0  # waiting or writing
+        self.writing = False
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.cond:
+            while self.writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.cond:
+            self.writers += 1
+            while self.readers or self.writing:
+                self.cond.wait()
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writers -= 1
+                self.writing = False
+                self.cond.notify_all()
+
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Unix socket server answering QueryHandler requests on the prepared
+    topology, the state in G shared by all of them. Requests read it
+    together and reloads replace it alone (self.lock); placements, which
+    change the selection state, also take turns (self.placing).
+    """
+    daemon_threads = True
+
+    def __init__(self, path):
+        SocketServer.UnixStreamServer.__init__(self, path, QueryHandler)
+        self.lock = RWLock()
+        self.placing = threading.Lock()
+        self.pristine = dict((k, copy.deepcopy(v)) for k, v in vars(G).items()
+                             if not k.startswith("__") and k not in G.LAZY)
+        self.loaded = None  # mtimes of the files the state was loaded from
+        self.ready = False
+
+    def watched(self):
+        """
+        :return: mtimes of the map, routing map and node list
+        """
+        return tuple(os.stat(f).st_mtime if os.path.exists(f) else None
+                     for f in (ARGS.map, ARGS.fgrfile, ARGS.nodefile) if f)
+
+    def reload(self):
+        """
+        rebuild G from its initial state and fgr_prepare()
+        """
+        with self.lock.write():
+            mtimes = self.watched()
+            for k, v in self.pristine.items():
+                setattr(G, k, copy.deepcopy(v))
+            G.unload(*G.LAZY)
+            self.ready = False
+            start = time.time()
+            try:
+                fgr_prepare()
+                do_fgrfile()
+                build_rtr_clients()
+            except SystemExit:
+                logger.error("Reload failed, retrying on the next change")
+                self.loaded = mtimes
+                return
+            self.loaded, self.ready = mtimes, True
+            logger.info("Loaded %s and %s in %.2f seconds", ARGS.map, ARGS.fgrfile, time.time() - start)
+
+    def watch(self, interval):
+        while True:
+            time.sleep(interval)
+            if self.watched() != self.loaded:
+                logger.info("Files changed, reloading")
+                self.reload()
+
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    """
+    One JSON request per line, each answered by one JSON line:
+
+        {"op": "node", "nid": 4070} or {"op": "node", "cname": "c0-0c0s1n0"}
+        {"op": "route", "nid": 4070} and optionally "lnet": 228
+        {"op": "placement", "partition": "atlas", "numranks": 2016, ...}
+        {"op": "reload"}
+
+    A placement is answered with its job script, in "script", and its
+    ranks, the OST, LNET, router and cost of which are null in a random
+    placement. Failed requests are answered with {"error": "..."}.
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+                if request.get("op") == "reload":
+                    self.server.reload()
+                    reply = {"ready": self.server.ready}
+                else:
+                    with self.server.lock.read():
+                        if not self.server.ready:
+                            raise ValueError("topology is not loaded")
+                        if request.get("op") == "placement":
+                            with self.server.placing:
+                                reply = serve_request(request)
+                        else:
+                            reply = serve_request(request)
+            except (ValueError, KeyError, TypeError), e:
+                reply = {"error": str(e)}
+            self.wfile.write(json.dumps(reply) + "\n")
+
+
+def serve_nid(request):
+    """
+    :return: the nid a request refers to, by "nid" or "cname"
+    """
+    if "cname" in request:
+        if request["cname"] not in G.CNAME2NID:
+            raise ValueError("unknown cname %s" % request["cname"])
+        return G.CNAME2NID[request["cname"]]
+    nid = int(request["nid"])
+    if not 0 <= nid < len(G.COMPUTE) or not G.NID2CNAME[nid]:
+        raise ValueError("unknown nid %s" % nid)
+    return nid
 
-    x = np.array(per_client_costs)
-    y = np.array(all_client_costs)
 
-    # compute avg, min, max
-    print("Per client: min = {:.2f}, max = {:.2f}, avg = {:.2f}, std = {:.2f}".
-          format(x.min(), x.max(), x.mean(), x.std()))
+def serve_option(request, key, default):
+    """
+    :return: request[key], default if missing, checked against the type
+             of default; booleans are true/false or "true"/"false"
+    """
+    value = request.get(key, default)
+    if isinstance(default, bool):
+        if isinstance(value, bool):
+            return value
+        if value in ("true", "false"):
+            return value == "true"
+        raise ValueError("%s must be true or false" % key)
+    if isinstance(default, int):
+        if isinstance(value, (int, long, basestring)) and not isinstance(value, bool):
+            try:
+                return int(value)
+            except ValueError:
+                pass
+        raise ValueError("%s must be an integer" % key)
+    if not isinstance(value, basestring):
+        raise ValueError("%s must be a string" % key)
+    return str(value)
+
+
+def serve_request(request):
+    """
+    answer a QueryHandler request, G must be prepared
+    """
+    global ARGS
+    op = request.get("op")
+    if op == "node":
+        nid = serve_nid(request)
+        return {"nid": nid, "cname": G.NID2CNAME[nid], "compute": bool(G.COMPUTE[nid]),
+                "x": G.NID2X[nid], "y": G.NID2Y[nid], "z": G.NID2Z[nid], "gemini": gemini(nid)}
+
+    elif op == "route":
+        nid = serve_nid(request)
+        if G.COSTS.row[nid] < 0:
+            raise ValueError("nid %s is not in %s" % (nid, ARGS.fgrfile))
+        if "lnet" in request:
+            lnet = int(request["lnet"])
+            if not G.BASE_LNET <= lnet < G.BASE_LNET + G.NUM_LNETS:
+                raise ValueError("unknown lnet %s" % lnet)
+            rtr = int(G.COSTS.router_of(nid, lnet))
+            return {"nid": nid, "lnet": lnet, "router": rtr, "cost": G.COSTS.lookup(nid, rtr)}
+        return {"nid": nid, "routes": dict(("o2ib%s" % lnet, int(G.COSTS.router_of(nid, lnet)))
+                                           for lnet in xrange(G.BASE_LNET, G.BASE_LNET + G.NUM_LNETS))}
+
+    elif op == "placement":
+        import shutil
+        import tempfile
+        saved = ARGS
+        ARGS = argparse.Namespace(**vars(saved))
+        # the script goes into the reply, not the directory of the server
+        ARGS.outdir = tempfile.mkdtemp(prefix="fgr-serve-")
+        try:
+            for key, default in (("partition", "atlas2"), ("strategy", "hybrid"), ("numranks", 1008),
+                                 ("stripesize", "1M"), ("ranks_per_node", 1), ("max_per_gemini", 0),
+                                 ("linkload", False), ("setstripe_procs", 16), ("setstripe_batch", 32)):
+                setattr(ARGS, key, serve_option(request, key, default))
+            if ARGS.partition not in ("atlas1", "atlas2", "atlas") or \
+                    ARGS.strategy not in ("random", "hybrid", "optimal", "balanced"):
+                raise ValueError("unknown partition or strategy")
+            try:
+                check_placement()
+                clients = run_placement()
+            except SystemExit:
+                raise ValueError("placement failed, see the server log")
+            if clients is not None:
+                ranks = [(int(client), None, None, None, None)
+                         for client in clients for rank in xrange(G.RANKS_PER_NODE)]
+            else:
+                ranks = [(client, ost, lnet, rtr.nid, cost)
+                         for client, ost, cost, lnet, rtr in G.SELECTED_CLIENTS[:ARGS.numranks]]
+            with open(gen_ofile_name(), "r") as f:
+                script = f.read()
+            return {"ofile": os.path.basename(gen_ofile_name()), "script": script, "ranks": ranks}
+        finally:
+            shutil.rmtree(ARGS.outdir)
+            ARGS = saved
+
+    raise ValueError("unknown op %s" % op)
+
+
+def main_serve():
+    """
+    answer node, route and placement queries on a Unix socket
+    """
+    if os.path.exists(ARGS.socket):
+        os.unlink(ARGS.socket)
+    server = QueryServer(ARGS.socket)
+    server.reload()
+
+    watcher = threading.Thread(target=server.watch, args=(ARGS.poll,))
+    watcher.daemon = True
+    watcher.start()
+
+    # exit through the finally below on kill, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Serving on %s", ARGS.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(ARGS.socket)
 
-    print("All client: min = {:.2f}, max = {:.2f}, avg = {:.2f}, std = {:.2f}".
-          format(y.min(), y.max(), y.mean(), y.std()))
+
+def write_metrics(command):
+    """
+    log the time of each phase and write ARGS.metrics_out, with the
+    counters and the peak RSS of the run and of its children
+    """
+    import resource
+    wall = time.time() - START_TIME
+    phases = dict(G.PHASES)
+    phases["other"] = max(wall - sum(phases.values()), 0.0)
+    for name, seconds in sorted(phases.items(), key=operator.itemgetter(1), reverse=True):
+        logger.info("Phase %-12s %8.3f seconds %5.1f%%", name, seconds, 100 * seconds / wall if wall else 0)
+
+    if not ARGS.metrics_out:
+        return
+    metrics = {
+        "command": command,
+        "argv": sys.argv[1:],
+        "time": datetime.now().isoformat(),
+        "wall": wall,
+        "phases": phases,
+        "counters": dict(G.COUNTERS),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    with open(ARGS.metrics_out, "w") as f:
+        json.dump(metrics, f, indent=2, sort_keys=True)
+    logger.info("Metrics written to %s", ARGS.metrics_out)
+
+
+def run_profiled(command):
+    """
+    run ARGS.func under cProfile, the stats go to <command>.prof
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(ARGS.func)
+    finally:
+        profiler.dump_stats(command + ".prof")
+        logger.info("Profile written to %s.prof, see python -m pstats %s.prof", command, command)
 
 
 def setup_logging(loglevel):
@@ -1169,12 +3786,17 @@ def main():
 
     logger.debug(ARGS)
 
-    gen_rtr2lnet()
-
+    command = ARGS.func.__name__[len("main_"):]
     try:
-        ARGS.func()
+        if ARGS.profile:
+            run_profiled(command)
+        else:
+            ARGS.func()
     except KeyboardInterrupt:
         logger.info("Interrupted upon user request")
         sys.exit(1)
+    finally:
+        if ARGS.profile or ARGS.metrics_out:
+            write_metrics(command)
 
 if __name__ == "__main__": main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+    Generate synthetic torus topologies for fgr2.py
+
+Writes a map in the titan.map format, one "nid cname type x y z" line per
+node, and the router groups of the machine next to it as <map>.routers,
+which fgr2.py loads along with the map:
+
+    ./topogen.py --scale 4 --output big.map
+    ./fgr2.py rtgens --map big.map --fgrfile big-routing.map
+    ./fgr2.py placement --map big.map --fgrfile big-routing.map --numranks 8064
+
+The machine is laid out like Titan: cabinets of 3 cages of 8 slots of 4
+nodes, one cabinet column per X, one row of cabinets per 2 Y (n0/n1 and
+n2/n3 of a slot share a Gemini) and 8 Z per cage, with columns and rows
+folded onto the torus. A router group has a sub-group of 3 modules every
+4 Y, spread along X; the 4 nodes of a module are service nodes, n0/n2
+routing atlas1 and n1/n3 atlas2.
+
+--scale sizes the torus in multiples of Titan's 25x16x24, doubling X and Y
+in turn: 2 is 50x16x24, 4 is 50x32x24, 8 is 100x32x24. By default there
+are as many router groups per X as on Titan (9 for 25), and 112 OSTs per
+router group in each partition (1008 for 9).
+"""
+
+import argparse
+
+TITAN_DIMS = (25, 16, 24)
+TITAN_GROUPS = 9
+OSTS_PER_GROUP = 112
+
+
+def fold(i, n):
+    """
+    :return: torus coordinate of the i-th of n cabinets in a line, folded
+             so that neighbouring cabinets are at most 2 apart
+    """
+    return i // 2 if i % 2 == 0 else n - 1 - i // 2
+
+
+def scale_dims(scale):
+    """
+    :return: torus dimensions scale times Titan's, scale a power of 2
+    """
+    dx, dy, dz = TITAN_DIMS
+    while scale > 1:
+        if dx // TITAN_DIMS[0] <= dy // TITAN_DIMS[1]:
+            dx *= 2
+        else:
+            dy *= 2
+        scale //= 2
+    return dx, dy, dz
+
+
+def gen_nodes(dims):
+    """
+    :return: (cname, x, y, z) of every node, in NID order
+    """
+    dx, dy, dz = dims
+    nodes = []
+    for col in range(dx):
+        for row in range(dy // 2):
+            for cage in range(dz // 8):
+                for slot in range(8):
+                    z = cage * 8 + (slot if cage % 2 == 0 else 7 - slot)
+                    for n in range(4):
+                        y = 2 * fold(row, dy // 2) + n // 2
+                        nodes.append(("c%s-%sc%ss%sn%s" % (col, row, cage, slot, n), fold(col, dx), y, z))
+    return nodes
+
+
+def gen_router_groups(dims, ngroups):
+    """
+    :return: ngroups lists of router modules, sub-group after sub-group, the
+             n0 of sub-group i at Y = 4 * i and its 3 modules a third of X apart
+    """
+    dx, dy, dz = dims
+    cages = dz // 8
+    col_at = dict((fold(col, dx), col) for col in range(dx))
+    row_at = dict((fold(row, dy // 2), row) for row in range(dy // 2))
+
+    used = set()
+    groups = []
+    for g in range(ngroups):
+        modules = []
+        for i in range(dy // 4):
+            row = row_at[2 * i]
+            for m in range(3):
+                x = (m * dx // 3 + g * dx // (3 * ngroups)) % dx
+                for k in range(dx * cages * 8):
+                    cage, slot = divmod((g + k) % (cages * 8), 8)
+                    module = "c%s-%sc%ss%s" % (col_at[(x + k // (cages * 8)) % dx], row, cage, slot)
+                    if module not in used:
+                        break
+                used.add(module)
+                modules.append(module)
+        groups.append(modules)
+    return groups
+
+
+def write_topology(fname, dims, groups, osts):
+    routers = set(rtr for group in groups for rtr in group)
+    with open(fname, "w") as f:
+        for nid, (cname, x, y, z) in enumerate(gen_nodes(dims)):
+            kind = "service" if cname[:-2] in routers else "compute"
+            f.write("%s %s %s %s %s %s\n" % (nid, cname, kind, x, y, z))
+
+    with open(fname + ".routers", "w") as f:
+        f.write("# router groups of %s, %sx%sx%s torus\n" % ((fname,) + tuple(dims)))
+        f.write("osts %s\n" % osts)
+        for group in groups:
+            f.write(" ".join(group) + "\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synthetic topology generator")
+    parser.add_argument("--dims", type=int, nargs=3, metavar=("X", "Y", "Z"),
+                        help="Torus dimensions, default Titan's 25 16 24")
+    parser.add_argument("--scale", type=int, default=1, help="Torus size in multiples of Titan, a power of 2")
+    parser.add_argument("--groups", type=int, help="Router groups, 4 LNETs each, default 9 per 25 X")
+    parser.add_argument("--osts", type=int, help="OSTs of each partition, default 112 per router group")
+    parser.add_argument("--output", default="synthetic.map", help="Map filename, default synthetic.map")
+    args = parser.parse_args()
+
+    if args.scale < 1 or args.scale & (args.scale - 1):
+        parser.error("--scale must be a power of 2")
+    args.dims = tuple(args.dims or scale_dims(args.scale))
+    dx, dy, dz = args.dims
+    if dx < 3 or dy < 4 or dy % 4 or dz < 8 or dz % 8:
+        parser.error("X must be at least 3, Y a multiple of 4 and Z a multiple of 8")
+    args.groups = args.groups or max(TITAN_GROUPS * dx // TITAN_DIMS[0], 1)
+    if not 1 <= args.groups * 3 <= dx * dz:
+        parser.error("--groups must be 1 to %s for this torus" % (dx * dz // 3))
+    args.osts = args.osts or OSTS_PER_GROUP * args.groups
+    return args
+
+
+def main():
+    args = parse_args()
+    groups = gen_router_groups(args.dims, args.groups)
+    write_topology(args.output, args.dims, groups, args.osts)
+
+    dx, dy, dz = args.dims
+    print("%s: %sx%sx%s torus, %s nodes, %s router groups of %s modules, %s OSTs per partition" %
+          (args.output, dx, dy, dz, dx * dy * dz * 2, len(groups), len(groups[0]), args.osts))
+
+if __name__ == "__main__": main()